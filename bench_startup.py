@@ -0,0 +1,67 @@
+"""Startup benchmark: import time of main.py and time to the first served `/` request.
+
+Usage:
+    python bench_startup.py [--runs 5] [--port 8765]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure_import():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=HERE, check=True,
+                   env={**os.environ, "DISABLE_WARMUP": "1"},
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def measure_first_request(port):
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as res:
+                    res.read()
+                return time.perf_counter() - start
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError("Server exited before serving '/'.")
+                if time.perf_counter() - start > 60:
+                    raise RuntimeError("Server did not serve '/' within 60s.")
+                time.sleep(0.01)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    import_times = [measure_import() for _ in range(args.runs)]
+    first_request_times = [measure_first_request(args.port) for _ in range(args.runs)]
+
+    print(f"import main (subprocess, {args.runs} runs): "
+          f"median {statistics.median(import_times):.3f}s, max {max(import_times):.3f}s")
+    print(f"time to first '/' ({args.runs} runs): "
+          f"median {statistics.median(first_request_times):.3f}s, max {max(first_request_times):.3f}s")
+    target = 1.0
+    status = "OK" if statistics.median(first_request_times) < target else "SLOW"
+    print(f"target < {target:.1f}s: {status}")
+
+
+if __name__ == "__main__":
+    main()
@@ -174,7 +174,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
     // --- 4. TTS ---
-    function speak(text, onEndCallback = null) {
+    function speak(text, onEndCallback = null, audioUrl = null) {
             // ยกเลิกทุกเสียงเดิม + เพิ่ม token
             stopTTS();
             const myToken = ttsToken;   // จด token ชุดนี้ไว้
@@ -196,11 +196,16 @@ document.addEventListener('DOMContentLoaded', () => {
             chatStatus.textContent = 
                 currentLang === "th-TH" ? "กำลังสร้างเสียง..." : "Generating voice...";
 
-            fetch(`${API_URL}/synthesize-speech`, {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({ text: text, lang: currentLang })
-            })
+            // ถ้ามีไฟล์เสียงที่สร้างไว้ล่วงหน้า (เช่น หน้าหนังสือ) ให้ดึงไฟล์นั้นตรงๆ
+            const audioRequest = audioUrl
+                ? fetch(audioUrl).then(res => res.ok ? res : Promise.reject(new Error("Precomputed audio unavailable")))
+                : fetch(`${API_URL}/synthesize-speech`, {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({ text: text, lang: currentLang })
+                });
+
+            audioRequest
             .then(res => res.blob())
             .then(blob => {
                 // ถ้าระหว่างโหลดเสียงมีการเรียก stopTTS() แล้ว -> token เปลี่ยน -> ไม่ต้องเล่นเสียงนี้
@@ -860,7 +865,7 @@ document.addEventListener('DOMContentLoaded', () => {
             readContent.addEventListener("focus", () => {
                 const text = readContent.innerText.trim();
                 if (text.length > 0) {
-                    speak(text);
+                    speak(text, null, `${API_URL}/book-page-audio/${encodeURIComponent(currentBook)}/${currentPage}?lang=${currentLang}`);
                 }
             });
         }
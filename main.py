@@ -4,21 +4,36 @@ import sys
 import re
 import io
 import time
-import fitz  # PyMuPDF
-import chromadb
-import google.generativeai as genai # No more Ollama
 import shutil
 import json
+import threading
+import bisect
+import hashlib
+import tempfile
+import sqlite3
+import logging
+import uuid
+import random
+import functools
+import contextvars
+import cProfile
+import pstats
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
 from dotenv import load_dotenv
+from typing import List, Optional
 from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException, status, UploadFile, File, BackgroundTasks, Form
+from fastapi import FastAPI, HTTPException, status, UploadFile, File, BackgroundTasks, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from typhoon_ocr import ocr_document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
 
-# --- gTTS Imports ---
-from gtts import gTTS
+# NOTE: chromadb, google.generativeai, typhoon_ocr, gTTS, fitz (PyMuPDF) and
+# langchain are imported lazily inside the functions that use them, so the
+# server can accept connections before the heavy clients are loaded.
 
 # --- 1. Setup & Config ---
 print("Server starting...")
@@ -34,25 +49,157 @@ app.add_middleware(
 # --- 2. Model & DB Config ---
 EMBEDDING_MODEL = "models/text-embedding-004"
 
-# --- NEW: Global Scanning Lock ---
-IS_SCANNING = False
-
 # --- Cache Directories ---
 INGEST_PAGE_CACHE_DIR = "ingest_page_cache"
 INGEST_SUMMARY_CACHE_DIR = "ingest_summary_cache"
 UPLOAD_DIR = "uploaded_books"
 LIBRARY_FILE = "library.json"
 QUESTION_BANK_CACHE_DIR = "question_bank_cache"
+AUDIO_CACHE_DIR = "audio_cache"
 
 for dir_path in [
     INGEST_PAGE_CACHE_DIR, 
     INGEST_SUMMARY_CACHE_DIR, 
     UPLOAD_DIR, 
-    QUESTION_BANK_CACHE_DIR 
+    QUESTION_BANK_CACHE_DIR,
+    AUDIO_CACHE_DIR
 ]:
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
 
+# --- Shared State (safe across `uvicorn --workers N`) ---
+# Everything mutable lives on disk: library.json behind a file lock, the chat
+# cache in a SQLite file and scan / ingest locks as flocks. Chroma must run in
+# server mode (CHROMA_HOST) with more than one worker: a local PersistentClient
+# keeps its index in memory, so only one process may open ./chroma_db.
+SHARED_STATE_DB = "shared_state.db"
+LOCK_DIR = "locks"
+CHROMA_WRITE_LOCK = os.path.join(LOCK_DIR, "chroma_write")
+CHROMA_LOCAL_LOCK = "chroma_local"  # held for the process lifetime by the one local-Chroma owner
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "5000"))
+
+os.makedirs(LOCK_DIR, exist_ok=True)
+
+@contextmanager
+def file_lock(path):
+    """Exclusive inter-process lock (flock) on `path`.lock; also excludes other threads."""
+    with open(f"{path}.lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def write_file_atomic(path, data):
+    """Writes bytes via a unique temp file in the same directory, so concurrent writers never mix.
+
+    Every cache / state file goes through here; a fixed "<path>.tmp" name lets
+    two writers interleave and the second os.replace fail.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates 0600 files
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_json_atomic(path, data):
+    # ensure_ascii=False for Thai
+    write_file_atomic(path, json.dumps(data, indent=4, ensure_ascii=False).encode('utf-8'))
+
+_sqlite_local = threading.local()
+
+def get_shared_db():
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(SHARED_STATE_DB, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS kv_cache (namespace TEXT, key TEXT, value TEXT, "
+                     "created_at REAL, PRIMARY KEY (namespace, key))")
+        _sqlite_local.conn = conn
+    return conn
+
+class SharedCache:
+    """Dict-like JSON cache shared by all worker processes through SQLite."""
+
+    def __init__(self, namespace, max_entries=CHAT_CACHE_MAX_ENTRIES):
+        self.namespace = namespace
+        self.max_entries = max_entries
+
+    def get(self, key, default=None):
+        row = get_shared_db().execute(
+            "SELECT value FROM kv_cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        conn = get_shared_db()
+        conn.execute(
+            "INSERT OR REPLACE INTO kv_cache (namespace, key, value, created_at) VALUES (?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value, ensure_ascii=False), time.time())
+        )
+        # Keep the cache bounded: drop the oldest entries beyond max_entries.
+        conn.execute(
+            "DELETE FROM kv_cache WHERE namespace = ? AND key IN (SELECT key FROM kv_cache WHERE namespace = ? "
+            "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_entries)
+        )
+
+    def delete_containing(self, fragment):
+        """Deletes every entry whose key contains `fragment`; returns the number removed."""
+        return get_shared_db().execute(
+            "DELETE FROM kv_cache WHERE namespace = ? AND instr(key, ?) > 0", (self.namespace, fragment)
+        ).rowcount
+
+_held_flocks = {}
+_held_flocks_guard = threading.Lock()
+
+def try_acquire_flock(name):
+    """Non-blocking named lock shared by all workers.
+
+    Backed by flock, so the OS releases it if the holding process dies: a
+    crashed scan or ingest never leaves a stale lock behind.
+    """
+    with _held_flocks_guard:
+        if name in _held_flocks:
+            return False
+        lock_file = open(os.path.join(LOCK_DIR, f"{name}.lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+        _held_flocks[name] = lock_file
+        return True
+
+def release_flock(name):
+    with _held_flocks_guard:
+        lock_file = _held_flocks.pop(name, None)
+    if lock_file is not None:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+# --- Global Scanning Lock (shared by all workers) ---
+SCAN_LOCK = "scan"
+
 # --- Library State Management ---
 library_data = {
     "categories": {
@@ -60,58 +207,340 @@ library_data = {
     },
     "books": {}
 }
+_library_mtime = None
+LIBRARY_LOCK = os.path.join(LOCK_DIR, "library")
 
 def load_library():
-    global library_data
+    global library_data, _library_mtime
     if os.path.exists(LIBRARY_FILE):
         try:
+            mtime = os.stat(LIBRARY_FILE).st_mtime_ns
             with open(LIBRARY_FILE, 'r', encoding='utf-8') as f:
                 library_data = json.load(f)
-            print("library.json loaded.")
+            _library_mtime = mtime
+            log_event("library.json loaded.")
         except Exception as e:
-            print(f"Warning: Could not load library.json. Using default. Error: {e}")
+            log_event(f"Could not load library.json. Using default. Error: {e}", logging.WARNING)
     else:
-        print("library.json not found, creating a new one.")
+        log_event("library.json not found, creating a new one.")
         save_library()
 
+def refresh_library():
+    """Reloads library.json if another worker has written it since we last read it."""
+    try:
+        mtime = os.stat(LIBRARY_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return library_data
+    if mtime != _library_mtime:
+        load_library()
+    return library_data
+
 def save_library():
-    global library_data
+    global library_data, _library_mtime
     try:
-        with open(LIBRARY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(library_data, f, indent=4)
-        print("library.json saved.")
+        write_file_atomic(LIBRARY_FILE, json.dumps(library_data, indent=4).encode('utf-8'))
+        _library_mtime = os.stat(LIBRARY_FILE).st_mtime_ns
+        log_event("library.json saved.")
     except Exception as e:
-        print(f"CRITICAL: Could not save library.json! Error: {e}")
+        log_event(f"Could not save library.json! Error: {e}", logging.CRITICAL)
+
+@contextmanager
+def library_transaction():
+    """Read-modify-write of library.json under an inter-process lock; saves on success."""
+    with file_lock(LIBRARY_LOCK):
+        load_library()
+        yield library_data
+        save_library()
 
 # --- End Library State ---
 
 
-gemini_chat_model = None
-try:
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-    if not GOOGLE_API_KEY:
-        raise Exception("GOOGLE_API_KEY not found in .env file")
-    genai.configure(api_key=GOOGLE_API_KEY)
-    gemini_chat_model = genai.GenerativeModel('models/gemini-2.5-flash')
-    print(f"Gemini ({gemini_chat_model.model_name}) loaded.")
-    genai.embed_content(model=EMBEDDING_MODEL, content="Test", task_type="RETRIEVAL_QUERY")
-    print(f"Gemini Embedding Model ({EMBEDDING_MODEL}) loaded.")
-except Exception as e:
-    print(f"!!! Warning: Gemini API failed. Error: {e} !!!")
+# --- Metrics & Tracing ---
+# Prometheus text-format counters / gauges / histograms kept in-process.
+# Every operation is a dict update under one lock, cheap enough to leave on.
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, help_text="", **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._help.setdefault(name, ("counter", help_text))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge_add(self, name, value, help_text="", **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._help.setdefault(name, ("gauge", help_text))
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name, value, help_text="", buckets=None, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._help.setdefault(name, ("histogram", help_text))
+            bounds = self._buckets.setdefault(name, buckets or HISTOGRAM_BUCKETS)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"buckets": [0] * len(bounds), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+                    break
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @staticmethod
+    def _format_labels(labels, extra=None):
+        items = list(labels) + (extra or [])
+        if not items:
+            return ""
+        escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]}
+                          for k, v in self._histograms.items()}
+            help_entries = dict(self._help)
+            bucket_bounds = dict(self._buckets)
+
+        lines = []
+        for name, (metric_type, help_text) in sorted(help_entries.items()):
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (metric_name, labels), hist in sorted(histograms.items()):
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(bucket_bounds[name], hist["buckets"]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {hist['sum']}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {hist['count']}")
+            else:
+                source = counters if metric_type == "counter" else gauges
+                for (metric_name, labels), value in sorted(source.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "request_id": request_id_var.get(),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False)
+
+logger = logging.getLogger("accessible_library")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(JSONLogFormatter())
+    logger.addHandler(_log_handler)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    logger.propagate = False
+
+def log_event(msg, level=logging.INFO, **fields):
+    logger.log(level, msg, extra={"fields": fields})
+
+@contextmanager
+def track_stage(stage):
+    """Times one pipeline stage (embed, vector_query, generate, json_parse, ocr, tts)."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("stage_errors_total", help_text="Failed pipeline stage calls.", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("stage_duration_seconds", elapsed, help_text="Pipeline stage latency.", stage=stage)
+        log_event("stage", logging.DEBUG, stage=stage, duration_ms=round(elapsed * 1000, 2))
+
+def record_cache(cache, hit):
+    metrics.inc("cache_requests_total", help_text="Cache lookups by cache and result.",
+                cache=cache, result="hit" if hit else "miss")
+
+def sampled_profile(name):
+    """Runs a sampled fraction (PROFILE_SAMPLE_RATE) of calls under cProfile and logs the top entries."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+                return func(*args, **kwargs)
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                stats_buffer = io.StringIO()
+                pstats.Stats(profiler, stream=stats_buffer).sort_stats("cumulative").print_stats(15)
+                log_event("profile", hot_path=name, stats=stats_buffer.getvalue())
+        return wrapper
+    return decorator
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.inc("http_requests_total", help_text="HTTP requests by route and status.",
+                    method=request.method, path=path, status=status_code)
+        metrics.observe("http_request_duration_seconds", elapsed, help_text="HTTP request latency.",
+                        method=request.method, path=path)
+        log_event("request", method=request.method, path=request.url.path, status=status_code,
+                  duration_ms=round(elapsed * 1000, 2))
+        request_id_var.reset(token)
+
+# --- Lazy Clients (initialized on first use, warmed up in background) ---
+_gemini_chat_model = None
+_collection = None
+_client_lock = threading.Lock()
+
+# Which subsystems are loaded; reported by /health and /ready. Set by the
+# warm-up and refreshed by every real call, so one failed warm-up is not final.
+subsystem_status = {
+    "gemini": {"warm": False, "error": None},
+    "embedding": {"warm": False, "error": None},
+    "chroma": {"warm": False, "error": None},
+}
 
-try:
-    client = chromadb.PersistentClient(path="./chroma_db") 
-    collection = client.get_or_create_collection(name="book_library")
-    print("ChromaDB connected.")
-except Exception as e:
-    print(f"FATAL: ChromaDB connection failed: {e}")
-    sys.exit(1)
+_genai_configured = False
+
+def get_genai():
+    global _genai_configured
+    import google.generativeai as genai # No more Ollama
+    if not _genai_configured:
+        GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+        if not GOOGLE_API_KEY:
+            raise Exception("GOOGLE_API_KEY not found in .env file")
+        genai.configure(api_key=GOOGLE_API_KEY)
+        _genai_configured = True
+    return genai
+
+def get_chat_model():
+    global _gemini_chat_model
+    if _gemini_chat_model is not None:
+        return _gemini_chat_model
+    with _client_lock:
+        if _gemini_chat_model is None:
+            try:
+                genai = get_genai()
+                _gemini_chat_model = genai.GenerativeModel('models/gemini-2.5-flash')
+                subsystem_status["gemini"] = {"warm": True, "error": None}
+                log_event(f"Gemini ({_gemini_chat_model.model_name}) loaded.")
+            except Exception as e:
+                subsystem_status["gemini"] = {"warm": False, "error": str(e)}
+                log_event(f"Gemini API failed. Error: {e}", logging.ERROR)
+                raise
+    return _gemini_chat_model
+
+def get_collection():
+    global _collection
+    if _collection is not None:
+        return _collection
+    with _client_lock:
+        if _collection is None:
+            try:
+                import chromadb
+                chroma_host = os.getenv("CHROMA_HOST")
+                if chroma_host:
+                    # Server mode: one Chroma process owns the index, all workers are clients.
+                    client = chromadb.HttpClient(host=chroma_host, port=int(os.getenv("CHROMA_PORT", "8000")))
+                else:
+                    # Another process's PersistentClient would never see this one's writes.
+                    if not try_acquire_flock(CHROMA_LOCAL_LOCK):
+                        raise RuntimeError("./chroma_db is already open in another worker process. "
+                                           "Set CHROMA_HOST (Chroma server mode) to run more than one worker.")
+                    client = chromadb.PersistentClient(path="./chroma_db")
+                _collection = client.get_or_create_collection(name="book_library")
+                subsystem_status["chroma"] = {"warm": True, "error": None}
+                log_event(f"ChromaDB connected ({'server ' + chroma_host if chroma_host else 'local'}).")
+            except Exception as e:
+                release_flock(CHROMA_LOCAL_LOCK)
+                subsystem_status["chroma"] = {"warm": False, "error": str(e)}
+                log_event(f"ChromaDB connection failed: {e}", logging.CRITICAL)
+                raise
+    return _collection
+
+def warm_up_clients():
+    """Loads the heavy clients in the background after the server is listening."""
+    log_event("Warm-up: loading heavy clients in background...")
+    start = time.perf_counter()
+    try:
+        get_chat_model()
+        get_genai().embed_content(model=EMBEDDING_MODEL, content="Test", task_type="RETRIEVAL_QUERY")
+        subsystem_status["embedding"] = {"warm": True, "error": None}
+        log_event(f"Gemini Embedding Model ({EMBEDDING_MODEL}) loaded.")
+    except Exception as e:
+        subsystem_status["embedding"] = {"warm": False, "error": str(e)}
+        log_event(f"Gemini warm-up failed. Error: {e}", logging.ERROR)
+    try:
+        get_collection()
+    except Exception:
+        pass
+    # Pre-import the remaining heavy modules so the first ingest / TTS call is fast.
+    for module_name in ["fitz", "typhoon_ocr", "gtts", "langchain_text_splitters"]:
+        try:
+            __import__(module_name)
+        except Exception as e:
+            log_event(f"Could not pre-import {module_name}. Error: {e}", logging.WARNING)
+    log_event(f"Warm-up finished in {time.perf_counter() - start:.2f}s.")
+
+chat_cache = SharedCache("chat")
 
-chat_cache = {}
+def clear_chat_cache(book_id):
+    # The chat cache outlives restarts, so answers must be dropped whenever a book's content changes.
+    removed = chat_cache.delete_containing(f"::{book_id}::")
+    if removed:
+        log_event(f"Cleared {removed} cached chat answers for {book_id}.")
 
 @app.on_event("startup")
 def on_startup():
-    load_library()
+    # uvicorn takes its default --workers from WEB_CONCURRENCY.
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 and not os.getenv("CHROMA_HOST"):
+        raise RuntimeError("Running several workers needs a shared Chroma server: set CHROMA_HOST.")
+    # Under the library lock: a worker creating the default library.json must
+    # not overwrite one another worker is writing.
+    with file_lock(LIBRARY_LOCK):
+        load_library()
+    if os.getenv("DISABLE_WARMUP") != "1":
+        threading.Thread(target=warm_up_clients, name="client-warmup", daemon=True).start()
+    if RESUME_INTERRUPTED_JOBS:
+        threading.Thread(target=resume_interrupted_jobs, name="resume-jobs", daemon=True).start()
     print("Server is ready.")
 
 # --- 3. INGEST LOGIC ---
@@ -128,33 +557,96 @@ def is_text_corrupted_v3(text, control_char_threshold=0.05, replacement_char_thr
     return False
 
 def embed_text_batch(texts_to_embed):
-    print(f"Embedding batch of {len(texts_to_embed)} chunks with Gemini...")
+    log_event(f"Embedding batch of {len(texts_to_embed)} chunks with Gemini...")
     try:
-        result = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=texts_to_embed,
-            task_type="RETRIEVAL_DOCUMENT"
-        )
+        with track_stage("embed"):
+            result = get_genai().embed_content(
+                model=EMBEDDING_MODEL,
+                content=texts_to_embed,
+                task_type="RETRIEVAL_DOCUMENT"
+            )
+        subsystem_status["embedding"] = {"warm": True, "error": None}
         return result['embedding']
     except Exception as e:
-        print(f"Error embedding batch with Gemini: {e}")
+        subsystem_status["embedding"] = {"warm": False, "error": str(e)}
+        log_event(f"Error embedding batch with Gemini: {e}", logging.ERROR)
         return [None] * len(texts_to_embed)
 
-def process_and_ingest_pdf(file_path: str, book_id: str, category_id: str, display_name: str):
-    print(f"\n--- BACKGROUND INGEST START: {book_id} ---")
-    
+# --- Ingest Checkpoints ---
+# ingest_page_cache/<book>/manifest.json records, per job, the source PDF hash,
+# each finished page (raw / ocr + content hash) and each embedded chunk batch.
+# A restarted ingest or scan of the same PDF skips everything already recorded,
+# so no OCR or embedding call is repeated.
+EMBED_BATCH_SIZE = 100
+RESUME_INTERRUPTED_JOBS = os.getenv("RESUME_INTERRUPTED_JOBS", "1") == "1"
+
+def sha256_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ingest_manifest_path(book_id):
+    return os.path.join(INGEST_PAGE_CACHE_DIR, book_id, "manifest.json")
+
+def load_ingest_manifest(book_id, job, pdf_hash, **job_info):
+    """Returns the manifest to resume from, or a fresh one if the job or the PDF changed."""
+    manifest = read_json_file(ingest_manifest_path(book_id), default={})
+    if manifest.get("job") == job and manifest.get("pdf_sha256") == pdf_hash:
+        done_pages = len(manifest.get("pages", {}))
+        done_batches = len(manifest.get("embedding", {}).get("done_batches", []))
+        log_event(f"Resuming {job} for {book_id}: {done_pages} pages and {done_batches} embedding batches already done.")
+        return manifest
+    return {"job": job, "pdf_sha256": pdf_hash, "pages": {}, "embedding": {}, "complete": False, **job_info}
+
+def save_ingest_manifest(book_id, manifest):
+    os.makedirs(os.path.join(INGEST_PAGE_CACHE_DIR, book_id), exist_ok=True)
+    write_json_atomic(ingest_manifest_path(book_id), manifest)
+
+def read_checkpointed_page(book_id, manifest, page_index):
+    """Returns the cached page text if the manifest says it is done and its hash still matches."""
+    entry = manifest["pages"].get(str(page_index))
+    page_cache_path = os.path.join(INGEST_PAGE_CACHE_DIR, book_id, f"page_{page_index}.txt")
+    if entry is None or not os.path.exists(page_cache_path):
+        return None
+    with open(page_cache_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    return text if sha256_text(text) == entry["sha256"] else None
+
+def extract_pages_with_checkpoints(pdf_path, book_id, manifest, check_corruption=True):
+    """Extracts (or OCRs) every page into the page cache, skipping checkpointed pages.
+
+    Returns (page_texts, chapters). The manifest is saved after every page;
+    pages whose OCR failed are listed in manifest["failed_pages"] and keep the
+    job incomplete, so the next resume retries exactly those pages.
+    """
+    import fitz  # PyMuPDF
+    from typhoon_ocr import ocr_document
+
     book_page_cache_dir = os.path.join(INGEST_PAGE_CACHE_DIR, book_id)
-    summary_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}.txt")
-    if not os.path.exists(book_page_cache_dir):
-        os.makedirs(book_page_cache_dir)
-        
+    os.makedirs(book_page_cache_dir, exist_ok=True)
+    doc = fitz.open(pdf_path)
+    pending_pages = len(doc)
+    metrics.gauge_add("ingest_pages_pending", pending_pages, help_text="Pages still waiting for text extraction / OCR.")
     try:
-        doc = fitz.open(file_path)
-        full_text_pages = [] 
-        
+        chapters = save_book_chapters(book_id, doc.get_toc(), len(doc))
+        manifest["page_count"] = len(doc)
+        full_text_pages = []
+
         for page_num, page in enumerate(doc):
             page_index = page_num + 1
-            print(f"    Ingesting page {page_index}/{len(doc)}...")
+            cached_text = read_checkpointed_page(book_id, manifest, page_index)
+            if cached_text is not None:
+                full_text_pages.append(cached_text)
+                pending_pages -= 1
+                metrics.gauge_add("ingest_pages_pending", -1)
+                continue
+
+            log_event(f"Ingesting page {page_index}/{len(doc)}...")
             raw_text = page.get_text("text") or ""
 
             # --- Detect emptiness / garbage ---
@@ -169,83 +661,451 @@ def process_and_ingest_pdf(file_path: str, book_id: str, category_id: str, displ
                 if ascii_ratio < 0.25 or few_spaces or has_replacement:
                     is_garbage = True
 
-            needs_ocr = is_empty or is_garbage or is_text_corrupted_v3(raw_text)
+            needs_ocr = is_empty or is_garbage or (check_corruption and is_text_corrupted_v3(raw_text))
 
             if needs_ocr:
-                print(f"    Page {page_index}: RAW text is empty/garbled → OCR fallback")
+                log_event(f"Page {page_index}: RAW text is empty/garbled → OCR fallback")
                 try:
-                    ocr_text = ocr_document(
-                        pdf_or_image_path=file_path,
-                        page_num=page_index
-                    )
+                    with track_stage("ocr"):
+                        ocr_text = ocr_document(
+                            pdf_or_image_path=pdf_path,
+                            page_num=page_index
+                        )
                     text_to_use = ocr_text.strip()
-                    print("    OCR success. Waiting 3.1s...")
+                    source = "ocr"
+                    log_event("OCR success. Waiting 3.1s...")
                     time.sleep(3.1)
                 except Exception as e:
-                    print(f"    OCR failed: {e}. Saving blank.")
+                    log_event(f"OCR failed: {e}. Saving blank.", logging.WARNING)
                     text_to_use = ""
+                    source = None  # not checkpointed: a resumed run retries the OCR
             else:
-                print(f"    Page {page_index}: RAW text OK → using extracted text.")
+                log_event(f"Page {page_index}: RAW text OK → using extracted text.")
                 text_to_use = raw_text.strip()
+                source = "raw"
 
-            
+            # Page file first, then the manifest entry that vouches for it.
             page_cache_path = os.path.join(book_page_cache_dir, f"page_{page_index}.txt")
-            with open(page_cache_path, 'w', encoding='utf-8') as f:
-                f.write(text_to_use)
-            
+            write_file_atomic(page_cache_path, text_to_use.encode('utf-8'))
+            failed_pages = set(manifest.get("failed_pages", []))
+            if source is not None:
+                manifest["pages"][str(page_index)] = {"source": source, "sha256": sha256_text(text_to_use)}
+                failed_pages.discard(page_index)
+            else:
+                failed_pages.add(page_index)
+            manifest["failed_pages"] = sorted(failed_pages)
+            save_ingest_manifest(book_id, manifest)
+
             full_text_pages.append(text_to_use)
-        
+            pending_pages -= 1
+            metrics.gauge_add("ingest_pages_pending", -1)
+
+        return full_text_pages, chapters
+    finally:
         doc.close()
+        if pending_pages:
+            metrics.gauge_add("ingest_pages_pending", -pending_pages)
+
+def embed_chunks_with_checkpoints(book_id, structured_chunks, manifest, collection):
+    """Embeds and upserts chunks in EMBED_BATCH_SIZE batches, skipping batches the manifest marks done.
+
+    Returns (batches_done, batches_total).
+    """
+    chunks_hash = sha256_text(json.dumps(structured_chunks, ensure_ascii=False, sort_keys=True))
+    embedding = manifest.get("embedding", {})
+    if embedding.get("chunks_sha256") != chunks_hash or embedding.get("batch_size") != EMBED_BATCH_SIZE:
+        # New chunk layout: start from a clean index for this book.
+        log_event(f"Deleting old RAG entries for {book_id}...")
+        with file_lock(CHROMA_WRITE_LOCK):
+            collection.delete(where={"book_id": book_id})
+        embedding = {"chunks_sha256": chunks_hash, "batch_size": EMBED_BATCH_SIZE, "done_batches": []}
+        manifest["embedding"] = embedding
+        save_ingest_manifest(book_id, manifest)
+
+    done_batches = set(embedding["done_batches"])
+    batch_starts = range(0, len(structured_chunks), EMBED_BATCH_SIZE)
+    for batch_index, start in enumerate(batch_starts):
+        if batch_index in done_batches:
+            continue
+        batch = structured_chunks[start:start + EMBED_BATCH_SIZE]
+        embeddings = embed_text_batch([text for text, _ in batch])
+        if any(emb is None for emb in embeddings):
+            log_event(f"Embedding batch {batch_index} failed; it will be retried on the next run.", logging.WARNING)
+            continue
+        # Local PersistentClient is single-writer: serialize index writes across workers.
+        with file_lock(CHROMA_WRITE_LOCK):
+            collection.upsert(
+                embeddings=embeddings,
+                documents=[text for text, _ in batch],
+                metadatas=[metadata for _, metadata in batch],
+                ids=[f"{book_id}_chunk_{metadata['chunk_num']}" for _, metadata in batch]
+            )
+        embedding["done_batches"].append(batch_index)
+        save_ingest_manifest(book_id, manifest)
+    return len(embedding["done_batches"]), len(batch_starts)
+
+def resume_interrupted_jobs():
+    """Restarts ingests and scans whose manifest is incomplete (e.g. after a crash)."""
+    for book_id in sorted(os.listdir(INGEST_PAGE_CACHE_DIR)):
+        manifest = read_json_file(ingest_manifest_path(book_id))
+        if not manifest or manifest.get("complete"):
+            continue
+        pdf_path = os.path.join(UPLOAD_DIR, book_id)
+        if not os.path.exists(pdf_path):
+            continue
+        if manifest.get("job") == "ingest":
+            log_event(f"Resuming interrupted ingest for {book_id}...")
+            process_and_ingest_pdf(pdf_path, book_id, manifest.get("category_id", "uncategorized"),
+                                   manifest.get("display_name", book_id))
+        elif manifest.get("job") == "scan" and try_acquire_flock(SCAN_LOCK):
+            log_event(f"Resuming interrupted scan for {book_id}...")
+            scan_book_task(book_id)
+
+def build_structured_chunks(book_id, pages, chapters, chunk_size=1000, chunk_overlap=100):
+    """Splits per-page text chapter by chapter into chunks tagged with their page span and chapter.
+
+    pages is [(page_num, text), ...]; chunks never cross a chapter boundary.
+    Returns [(chunk_text, metadata), ...].
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
+    )
+    if not chapters:
+        chapters = fallback_chapters(max((page_num for page_num, _ in pages), default=0))
+
+    chunks = []
+    for chapter in chapters:
+        chapter_pages = [(n, text) for n, text in pages
+                         if chapter["page_start"] <= n <= chapter["page_end"] and text.strip()]
+        if not chapter_pages:
+            continue
+        # Character offset where each page starts inside the joined chapter text.
+        page_offsets = []
+        offset = 0
+        for _, text in chapter_pages:
+            page_offsets.append(offset)
+            offset += len(text) + 2
+        chapter_text = "\n\n".join(text for _, text in chapter_pages)
+
+        for doc in text_splitter.create_documents([chapter_text]):
+            start = doc.metadata.get("start_index", 0)
+            if start < 0:
+                start = 0
+            end = start + max(0, len(doc.page_content) - 1)
+            chunks.append((doc.page_content, {
+                "book_id": book_id,
+                "chunk_num": len(chunks),
+                "page_start": chapter_pages[bisect.bisect_right(page_offsets, start) - 1][0],
+                "page_end": chapter_pages[bisect.bisect_right(page_offsets, end) - 1][0],
+                "chapter": chapter["chapter"],
+                "chapter_title": chapter["title"],
+            }))
+    return chunks
+
+def process_and_ingest_pdf(file_path: str, book_id: str, category_id: str, display_name: str):
+    log_event(f"BACKGROUND INGEST START: {book_id}")
+    
+    # Held for the whole job; released automatically if the process dies.
+    ingest_lock = f"ingest_{book_id}"
+    if not try_acquire_flock(ingest_lock):
+        log_event(f"Ingest for {book_id} is already running in another worker. Skipping.")
+        return
+    summary_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}.txt")
+        
+    try:
+        manifest = load_ingest_manifest(book_id, "ingest", sha256_file(file_path),
+                                        category_id=category_id, display_name=display_name)
+        full_text_pages, chapters = extract_pages_with_checkpoints(file_path, book_id, manifest)
         
         full_document_text = "\n\n".join(full_text_pages)
         with open(summary_cache_path, 'w', encoding='utf-8') as f:
             f.write(full_document_text)
-        print(f"Full text cache saved to {summary_cache_path}")
-
-        print("Connecting to ChromaDB for RAG ingest...")
-        ingest_client = chromadb.PersistentClient(path="./chroma_db")
-        ingest_collection = ingest_client.get_or_create_collection(name="book_library")
-        print(f"Deleting old RAG entries for {book_id}...")
-        ingest_collection.delete(where={"book_id": book_id})
-
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        chunks = text_splitter.split_text(full_document_text)
-        if not chunks:
-            print(f"Warning: No text extracted from {book_id}. Skipping RAG.")
-            return
+        log_event(f"Full text cache saved to {summary_cache_path}")
 
-        print(f"Embedding batch of {len(chunks)} chunks for RAG...")
-        embeddings = embed_text_batch(chunks)
-        
-        valid_data = [(emb, doc, f"{book_id}_chunk_{i}", {"book_id": book_id, "chunk_num": i})
-                        for i, (emb, doc) in enumerate(zip(embeddings, chunks)) if emb is not None]
-        if not valid_data:
-            print("Error: No valid RAG embeddings.")
+        log_event("Connecting to ChromaDB for RAG ingest...")
+        ingest_collection = get_collection()
+
+        structured_chunks = build_structured_chunks(
+            book_id, list(enumerate(full_text_pages, start=1)), chapters
+        )
+        if not structured_chunks:
+            log_event(f"No text extracted from {book_id}. Skipping RAG.", logging.WARNING)
+            # Stays incomplete while OCR failures may still yield text on resume.
+            manifest["complete"] = not manifest.get("failed_pages")
+            save_ingest_manifest(book_id, manifest)
             return
-            
-        ingest_collection.add(
-            embeddings=[d[0] for d in valid_data],
-            documents=[d[1] for d in valid_data],
-            metadatas=[d[3] for d in valid_data],
-            ids=[d[2] for d in valid_data]
+
+        log_event(f"Embedding {len(structured_chunks)} chunks for RAG in batches of {EMBED_BATCH_SIZE}...")
+        batches_done, batches_total = embed_chunks_with_checkpoints(
+            book_id, structured_chunks, manifest, ingest_collection
         )
+        if batches_done == 0:
+            log_event("No valid RAG embeddings.", logging.ERROR)
+            return
+        # The index for this book changed: answers cached from the old one are stale.
+        clear_chat_cache(book_id)
         
-        global library_data
-        if category_id not in library_data["categories"]:
-            category_id = "uncategorized"
-            
-        library_data["books"][book_id] = {
-            "display_name": display_name,
-            "category": category_id
-        }
-        save_library()
+        with library_transaction() as library:
+            if category_id not in library["categories"]:
+                category_id = "uncategorized"
+                
+            library["books"][book_id] = {
+                "display_name": display_name,
+                "category": category_id
+            }
+
+        if batches_done < batches_total:
+            log_event(f"BACKGROUND INGEST PARTIAL: {book_id} ({batches_done}/{batches_total} batches). Will resume.")
+            return
+        if manifest.get("failed_pages"):
+            log_event(f"BACKGROUND INGEST PARTIAL: {book_id} has pages without text {manifest['failed_pages']}. "
+                      f"OCR will be retried on resume.", logging.WARNING)
+            return
+        manifest["complete"] = True
+        save_ingest_manifest(book_id, manifest)
         
-        print(f"--- BACKGROUND INGEST COMPLETE: {book_id} ---")
+        log_event(f"BACKGROUND INGEST COMPLETE: {book_id}")
+
+        if PRECOMPUTE_ENABLED:
+            precompute_book_task(book_id)
 
     except Exception as e:
-        print(f"!!! FATAL INGEST ERROR for {book_id}: {e} !!!")
+        log_event(f"FATAL INGEST ERROR for {book_id}: {e}", logging.ERROR)
     finally:
-        print(f"Ingest complete. Original PDF retained at {file_path}")
+        release_flock(ingest_lock)
+        log_event(f"Ingest complete. Original PDF retained at {file_path}")
+
+
+# --- LLM Structured Output & Parsing ---
+# Gemini is asked for schema-constrained JSON (response_mime_type + response_schema).
+# Question banks are streamed and parsed item by item, so one broken object only
+# costs that object; missing items are re-requested instead of the whole bank.
+QUESTION_DIFFICULTIES = ["easy", "medium", "hard"]
+QB_MAX_REPAIR_ROUNDS = int(os.getenv("QB_MAX_REPAIR_ROUNDS", "2"))
+CODE_FENCE_REGEX = re.compile(r"^```(?:json)?\s*|\s*```$", flags=re.MULTILINE)
+
+CHAT_ANSWER_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "structured": {"type": "STRING"},
+        "speech": {"type": "STRING"},
+    },
+    "required": ["structured", "speech"],
+}
+
+QUESTION_LIST_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "question": {"type": "STRING"},
+            "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "correctAnswerIndex": {"type": "INTEGER"},
+            "difficulty": {"type": "STRING", "enum": QUESTION_DIFFICULTIES},
+        },
+        "required": ["question", "options", "correctAnswerIndex", "difficulty"],
+    },
+}
+
+def json_generation_config(schema):
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+def strip_code_fences(text):
+    return CODE_FENCE_REGEX.sub("", text.strip())
+
+def parse_llm_json_object(text, required_keys=()):
+    """Parses a JSON object from an LLM response, tolerating fences and surrounding prose."""
+    cleaned = strip_code_fences(text)
+    try:
+        data = json.loads(cleaned)
+    except json.JSONDecodeError:
+        start = cleaned.find("{")
+        if start == -1:
+            raise ValueError("No JSON object found in LLM response.")
+        data, _ = json.JSONDecoder().raw_decode(cleaned, start)
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object, got {type(data).__name__}.")
+    missing = [k for k in required_keys if k not in data]
+    if missing:
+        raise ValueError(f"LLM JSON is missing keys: {missing}")
+    return data
+
+def normalize_question(item):
+    """Returns a cleaned question dict, or None if the item cannot be used."""
+    if not isinstance(item, dict):
+        return None
+    question = item.get("question")
+    options = item.get("options")
+    answer_index = item.get("correctAnswerIndex")
+    if not isinstance(question, str) or not question.strip():
+        return None
+    if not isinstance(options, list) or len(options) < 2 or not all(isinstance(o, str) for o in options):
+        return None
+    if isinstance(answer_index, str) and answer_index.strip().isdigit():
+        answer_index = int(answer_index)
+    if not isinstance(answer_index, int) or isinstance(answer_index, bool) or not 0 <= answer_index < len(options):
+        return None
+    difficulty = str(item.get("difficulty", "")).strip().lower()
+    if difficulty not in QUESTION_DIFFICULTIES:
+        difficulty = "medium"
+    return {
+        "question": question.strip(),
+        "options": options,
+        "correctAnswerIndex": answer_index,
+        "difficulty": difficulty,
+    }
+
+class StreamingJSONArrayParser:
+    """Incrementally parses the items of a top-level JSON array as text arrives.
+
+    feed() returns the items completed by that piece of text. finish() scans
+    whatever could not be parsed and salvages any later well-formed objects.
+    """
+
+    def __init__(self, validator=None):
+        self.validator = validator
+        self.items = []
+        self.rejected = 0
+        self._buffer = ""
+        self._pos = None  # index just after '[' once the array has started
+        self._done = False
+        self._decoder = json.JSONDecoder()
+
+    def _accept(self, item, new_items):
+        if self.validator is not None:
+            item = self.validator(item)
+            if item is None:
+                self.rejected += 1
+                return
+        self.items.append(item)
+        new_items.append(item)
+
+    def feed(self, text):
+        new_items = []
+        self._buffer += text
+        if self._done:
+            return new_items
+        if self._pos is None:
+            start = self._buffer.find("[")
+            if start == -1:
+                return new_items
+            self._pos = start + 1
+
+        while True:
+            pos = self._pos
+            while pos < len(self._buffer) and self._buffer[pos] in " \t\r\n,":
+                pos += 1
+            self._pos = pos
+            if pos >= len(self._buffer):
+                return new_items
+            if self._buffer[pos] == "]":
+                self._done = True
+                return new_items
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:
+                # Either incomplete (wait for more text) or malformed (salvaged in finish()).
+                return new_items
+            self._pos = end
+            self._accept(item, new_items)
+
+    def finish(self):
+        """Salvages well-formed objects that follow a malformed one; returns them."""
+        new_items = []
+        if self._done:
+            return new_items
+        if self._pos is None:
+            # No array at all: the model may have returned a single object.
+            self._pos = 0
+        pos = self._pos
+        while True:
+            start = self._buffer.find("{", pos)
+            if start == -1:
+                break
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, start)
+            except json.JSONDecodeError:
+                pos = start + 1
+                continue
+            self._accept(item, new_items)
+            pos = end
+        self._pos = len(self._buffer)
+        self._done = True
+        if new_items:
+            metrics.inc("llm_json_salvaged_items_total", len(new_items),
+                        help_text="Items recovered from malformed LLM JSON arrays.")
+        return new_items
+
+def stream_json_array(prompt, schema, validator=None):
+    """Streams a JSON-array generation and returns (valid_items, rejected_count)."""
+    parser = StreamingJSONArrayParser(validator=validator)
+    with track_stage("generate"):
+        response = get_chat_model().generate_content(
+            prompt, generation_config=json_generation_config(schema), stream=True
+        )
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. safety / finish metadata).
+                continue
+            with track_stage("json_parse"):
+                parser.feed(text)
+    with track_stage("json_parse"):
+        parser.finish()
+    return parser.items, parser.rejected
+
+def difficulty_plan(total, existing=(), target=None):
+    """Questions still needed per difficulty: `target` (default a 40/40/20 split of `total`) minus `existing`."""
+    if target is None:
+        easy = round(total * 0.4)
+        medium = round(total * 0.4)
+        target = {"easy": easy, "medium": medium, "hard": total - easy - medium}
+    target = dict(target)
+    for item in existing:
+        if target.get(item["difficulty"], 0) > 0:
+            target[item["difficulty"]] -= 1
+    return target
+
+def fit_difficulty_plan(plan, count):
+    """Trims or pads (with medium) a difficulty plan so it asks for exactly `count` questions."""
+    plan = dict(plan)
+    while sum(plan.values()) > count:
+        plan[max(plan, key=plan.get)] -= 1
+    plan["medium"] += count - sum(plan.values())
+    return plan
+
+def generate_question_list(build_prompt, count, label="", target_plan=None):
+    """Generates `count` questions, re-requesting only the missing portion on partial output.
+
+    build_prompt(count, difficulty_counts, exclude_questions) returns the prompt text.
+    target_plan fixes the easy/medium/hard mix; by default it is 40/40/20 of `count`.
+    """
+    questions = []
+    seen = set()
+    for attempt in range(QB_MAX_REPAIR_ROUNDS + 1):
+        missing = count - len(questions)
+        if missing <= 0:
+            break
+        plan = fit_difficulty_plan(difficulty_plan(count, questions, target_plan), missing)
+        if attempt > 0:
+            metrics.inc("llm_json_repair_requests_total", help_text="Follow-up requests for missing JSON items.")
+            log_event(f"{label} Re-requesting {missing} missing questions (attempt {attempt + 1})...")
+        prompt = build_prompt(missing, plan, [q["question"] for q in questions])
+        try:
+            items, rejected = stream_json_array(prompt, QUESTION_LIST_SCHEMA, validator=normalize_question)
+        except Exception as e:
+            log_event(f"{label} Generation attempt {attempt + 1} failed: {e}", logging.WARNING)
+            continue
+        if rejected:
+            log_event(f"{label} Dropped {rejected} malformed questions.")
+        for item in items:
+            key = item["question"].casefold()
+            if key not in seen:
+                seen.add(key)
+                questions.append(item)
+    return questions[:count]
 
 
 # --- 4. API Endpoints (Core App) ---
@@ -254,46 +1114,100 @@ class ChatQuery(BaseModel):
     query: str
     book_id: str
     lang: str
+    page: Optional[int] = None     # scope retrieval to the page being read (± PAGE_SCOPE_WINDOW)
+    chapter: Optional[int] = None  # scope retrieval to one chapter
 
 class TTSRequest(BaseModel):
     text: str
     lang: str
 
-def retrieve_chunks(query, book_id, n_results=15):
+PAGE_SCOPE_WINDOW = 1
+SCOPED_N_RESULTS = 5
+
+def build_retrieval_filter(book_id, page=None, chapter=None):
+    conditions = [{"book_id": book_id}]
+    if page is not None:
+        # A chunk overlaps [page - w, page + w] when it starts before the end and ends after the start.
+        conditions.append({"page_start": {"$lte": page + PAGE_SCOPE_WINDOW}})
+        conditions.append({"page_end": {"$gte": page - PAGE_SCOPE_WINDOW}})
+    if chapter is not None:
+        conditions.append({"chapter": chapter})
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def retrieve_chunks(query, book_id, n_results=15, page=None, chapter=None):
+    return [record["text"] for record in retrieve_chunk_records(query, book_id, n_results, page, chapter)]
+
+@sampled_profile("retrieve_chunks")
+def retrieve_chunk_records(query, book_id, n_results=15, page=None, chapter=None):
+    """Returns [{"text", "metadata"}, ...]; page / chapter scoping falls back to the whole book if empty."""
+    is_scoped = page is not None or chapter is not None
     try:
-        print(f"Embedding query with Gemini: {query[:30]}...")
-        result = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=query,
-            task_type="RETRIEVAL_QUERY"
-        )
+        log_event(f"Embedding query with Gemini: {query[:30]}...")
+        try:
+            with track_stage("embed"):
+                result = get_genai().embed_content(
+                    model=EMBEDDING_MODEL,
+                    content=query,
+                    task_type="RETRIEVAL_QUERY"
+                )
+        except Exception as e:
+            subsystem_status["embedding"] = {"warm": False, "error": str(e)}
+            raise
+        subsystem_status["embedding"] = {"warm": True, "error": None}
         query_embedding = result['embedding']
         
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n_results,
-            where={"book_id": book_id}
-        )
-        print(f"ChromaDB found {len(results['documents'][0])} chunks.")
-        return results['documents'][0] if results['documents'] else []
+        with track_stage("vector_query"):
+            results = get_collection().query(
+                query_embeddings=[query_embedding],
+                n_results=SCOPED_N_RESULTS if is_scoped else n_results,
+                where=build_retrieval_filter(book_id, page, chapter)
+            )
+            if is_scoped and not (results['documents'] and results['documents'][0]):
+                # Books ingested before page metadata existed have no page_start / chapter fields.
+                log_event("No chunks in the requested scope. Retrying over the whole book.")
+                results = get_collection().query(
+                    query_embeddings=[query_embedding],
+                    n_results=n_results,
+                    where={"book_id": book_id}
+                )
+        documents = results['documents'][0] if results['documents'] else []
+        metadatas = results['metadatas'][0] if results.get('metadatas') else [{}] * len(documents)
+        log_event(f"ChromaDB found {len(documents)} chunks.")
+        return [{"text": doc, "metadata": meta or {}} for doc, meta in zip(documents, metadatas)]
     except Exception as e:
-        print(f"Error retrieving chunks: {e}")
+        log_event(f"Error retrieving chunks: {e}", logging.ERROR)
         return []
 
-def get_dual_output_prompt(query, context_chunks, lang):
-    context = "\n---\n".join(context_chunks)
-    
-    if lang == 'th-TH':
-        return f"""
+def get_chunk_sources(context_records):
+    """Distinct page spans / chapters of the retrieved chunks, in page order, for citing."""
+    sources = {}
+    for record in context_records:
+        meta = record["metadata"]
+        if "page_start" not in meta:
+            continue
+        key = (meta["page_start"], meta["page_end"])
+        sources[key] = {"page_start": meta["page_start"], "page_end": meta["page_end"],
+                        "chapter": meta.get("chapter"), "chapter_title": meta.get("chapter_title")}
+    return [sources[key] for key in sorted(sources)]
+
+# --- Prompt Assembly (static prefix + token-budgeted context) ---
+# The instruction block for each language is a module constant placed at the
+# very start of the prompt, ahead of the per-request CONTEXT and QUESTION. The
+# blocks (~300 tokens English, ~650 Thai) are below Gemini's minimum size for
+# implicit or explicit context caching (~1024 tokens), so they are not expected
+# to be served from cache; llm_cached_prompt_tokens_total only reports what
+# Gemini says it cached. Token savings come from the context budget and the
+# dedupe / overlap trimming below.
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "6000"))
+CHUNK_OVERLAP_CHARS = 100  # must match the splitter's chunk_overlap used at ingest
+MIN_STRIP_OVERLAP_CHARS = 20  # shorter repeats between chunks are left alone
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+CHAT_PROMPT_PREFIX = {
+    'th-TH': """
         คุณคืออาจารย์ผู้เชี่ยวชาญที่กำลังสอนหนังสือเล่มนี้
         **ภารกิจ:** ตอบคำถามของผู้เรียน โดยใช้ "เนื้อหาที่คัดมา (CONTEXT)" เป็นหลัก แต่คุณสามารถใช้ความรู้ทั่วไปเสริมได้เพื่อให้เข้าใจง่ายขึ้น
-        
-        **CONTEXT (เนื้อหาจากหนังสือ):**
-        {context}
-        ---
-        **QUESTION (คำถามผู้เรียน):**
-        {query}
-        
+
         **กฎการตอบ (คิดแบบผู้สอน):**
         1. **ถ้าคำตอบอยู่ใน CONTEXT:** อธิบายให้ชัดเจน ยกตัวอย่างจากเนื้อหา และตอบอย่างมั่นใจ
         2. **ถ้าคำตอบไม่อยู่ใน CONTEXT โดยตรง:**
@@ -304,22 +1218,15 @@ def get_dual_output_prompt(query, context_chunks, lang):
         3. **สไตล์การตอบ:** เป็นกันเอง เหมือนผู้สอนสอนผู้เรียน ไม่ใช่หุ่นยนต์ กระตือรือร้นที่จะช่วย
 
         **รูปแบบ JSON ที่ต้องตอบกลับ (ห้ามเปลี่ยนโครงสร้าง):**
-        {{
+        {
             "structured": "คำตอบแบบละเอียด จัดรูปแบบสวยงามด้วย Markdown (ใช้หัวข้อ ##, ตัวหนา **bold**, รายการ *)",
             "speech": "คำตอบเดียวกันที่เขียนใหม่เป็นภาษาพูด ย่อหน้าเดียว สั้นกระชับ เป็นธรรมชาติ (สำหรับอ่านออกเสียง)"
-        }}
-        """
-    else:
-        return f"""
+        }
+        """,
+    'en': """
         You are an expert professor teaching this specific book.
         **Mission:** Answer the student's question. Prioritize the provided "CONTEXT", but use your general knowledge to bridge gaps.
 
-        **CONTEXT (Excerpts from the book):**
-        {context}
-        ---
-        **QUESTION:**
-        {query}
-
         **Thinking Process (Act like a Teacher):**
         1. **Direct Match:** If the answer is in the CONTEXT, explain it clearly using examples from the text.
         2. **No Direct Match:**
@@ -330,11 +1237,114 @@ def get_dual_output_prompt(query, context_chunks, lang):
         3. **Tone:** Helpful, educational, and encouraging.
 
         **Required JSON Output:**
-        {{
+        {
             "structured": "A detailed answer formatted in clean Markdown (Use ## Headings, **bold**, * lists).",
             "speech": "The same answer rewritten as a single, natural-sounding spoken paragraph (for TTS)."
-        }}
+        }
+        """,
+}
+
+CHAT_PROMPT_LABELS = {
+    'th-TH': ("**CONTEXT (เนื้อหาจากหนังสือ):**", "**QUESTION (คำถามผู้เรียน):**"),
+    'en': ("**CONTEXT (Excerpts from the book):**", "**QUESTION:**"),
+}
+
+def estimate_tokens(text):
+    """Cheap token estimate: ~4 chars per token for Latin script, ~1.5 for Thai and other scripts."""
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return int(ascii_chars / 4 + (len(text) - ascii_chars) / 1.5) + 1
+
+def strip_overlap(previous, current, max_overlap=CHUNK_OVERLAP_CHARS * 2, min_overlap=MIN_STRIP_OVERLAP_CHARS):
+    """Removes the prefix of `current` that repeats the end of `previous` (splitter overlap).
+
+    Matches shorter than min_overlap are coincidences (e.g. a shared "s"), not overlap.
+    """
+    limit = min(len(previous), len(current), max_overlap)
+    for size in range(limit, min_overlap - 1, -1):
+        if previous.endswith(current[:size]):
+            return current[size:]
+    return current
+
+def assemble_context(context_records, token_budget=CHAT_CONTEXT_TOKEN_BUDGET):
+    """Picks chunks by relevance until the token budget is spent, then orders them as in the book.
+
+    Duplicate chunks are dropped. Neighbouring chunks that share the splitter's
+    overlap become one continuous passage with the overlap removed; chunks that
+    share none stay separate passages.
+    Returns (passages, stats).
+    """
+    naive_tokens = sum(estimate_tokens(r["text"]) for r in context_records)
+    selected = []
+    seen_texts = set()
+    used_tokens = 0
+    for rank, record in enumerate(context_records):
+        text = record["text"].strip()
+        if not text or text in seen_texts:
+            continue
+        cost = estimate_tokens(text)
+        if used_tokens + cost > token_budget and selected:
+            continue
+        seen_texts.add(text)
+        selected.append((record["metadata"].get("chunk_num", rank), rank, text))
+        used_tokens += cost
+
+    # Book order lets consecutive chunks be stitched together without their overlap.
+    selected.sort(key=lambda item: (item[0], item[1]))
+    passages = []
+    previous_num = None
+    for chunk_num, _, text in selected:
+        is_next_chunk = passages and previous_num is not None and chunk_num == previous_num + 1
+        remainder = strip_overlap(passages[-1], text) if is_next_chunk else text
+        if is_next_chunk and len(remainder) < len(text):
+            passages[-1] += remainder
+        else:
+            # No shared overlap (e.g. a chapter boundary): gluing would run two sentences together.
+            passages.append(text)
+        previous_num = chunk_num
+
+    stats = {
+        "chunks_retrieved": len(context_records),
+        "chunks_used": len(selected),
+        "passages": len(passages),
+        "context_tokens_naive": naive_tokens,
+        "context_tokens": sum(estimate_tokens(p) for p in passages),
+    }
+    stats["context_tokens_saved"] = max(0, naive_tokens - stats["context_tokens"])
+    return passages, stats
+
+def build_chat_prompt(query, context_records, lang):
+    """Returns (prompt, stats) with the static instruction prefix first."""
+    prompt_lang = 'th-TH' if lang == 'th-TH' else 'en'
+    passages, stats = assemble_context(context_records)
+    context_label, question_label = CHAT_PROMPT_LABELS[prompt_lang]
+    context = "\n---\n".join(passages)
+    prompt = f"""{CHAT_PROMPT_PREFIX[prompt_lang]}
+        {context_label}
+        {context}
+        ---
+        {question_label}
+        {query}
         """
+    stats["prompt_tokens"] = estimate_tokens(prompt)
+    metrics.inc("prompt_context_tokens_saved_total", stats["context_tokens_saved"],
+                help_text="Estimated context tokens removed by dedupe / overlap trimming / budget.")
+    metrics.observe("prompt_tokens", stats["prompt_tokens"], help_text="Estimated prompt size per chat request.",
+                    buckets=TOKEN_BUCKETS)
+    log_event("prompt_assembled", **stats)
+    return prompt, stats
+
+def record_llm_usage(response, purpose):
+    """Records provider-reported token usage, including any tokens Gemini reports as cached."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+    metrics.inc("llm_prompt_tokens_total", prompt_tokens, help_text="Prompt tokens reported by Gemini.", purpose=purpose)
+    metrics.inc("llm_cached_prompt_tokens_total", cached_tokens,
+                help_text="Prompt tokens served from Gemini's context cache.", purpose=purpose)
+    log_event("llm_usage", purpose=purpose, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens,
+              output_tokens=getattr(usage, "candidates_token_count", 0) or 0)
 
 def get_smart_fallback_prompt(query, lang):
     if lang == 'th-TH':
@@ -355,47 +1365,137 @@ def get_smart_fallback_prompt(query, lang):
 def read_root():
     return {"status": "Accessible Library API is running"}
 
+# --- Metrics ---
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# --- Liveness / Readiness ---
+@app.get("/health")
+def health():
+    # Liveness: the process is up and serving, whatever the state of the clients.
+    return {"status": "alive", "subsystems": subsystem_status}
+
+@app.get("/ready")
+def ready():
+    # Readiness: RAG chat needs Gemini, the embedding model and ChromaDB warm.
+    is_ready = all(s["warm"] for s in subsystem_status.values())
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={"ready": is_ready, "subsystems": subsystem_status}
+    )
+
 # --- API 2: The "Ask" (RAG) Chatbot ---
+def chat_cache_key(query: ChatQuery):
+    # clear_chat_cache() relies on the book_id being wrapped in "::".
+    return f"{query.lang}::{query.book_id}::{query.page}::{query.chapter}::{query.query}"
+
 @app.post("/chat")
+@sampled_profile("chat")
 def final_chat(query: ChatQuery):
-    print(f"\n--- RAG Chat Query ---")
-    cache_key = f"{query.lang}::{query.book_id}::{query.query}"
-    if cache_key in chat_cache:
-        print("<<< Level 1: Returning from Cache >>>")
-        if isinstance(chat_cache[cache_key], dict) and "structured" in chat_cache[cache_key]:
-             return chat_cache[cache_key]
+    log_event("RAG Chat Query")
+    cache_key = chat_cache_key(query)
+    cached = chat_cache.get(cache_key)
+    record_cache("chat", isinstance(cached, dict) and "structured" in cached)
+    if cached is not None:
+        log_event("Level 1: Returning from Cache")
+        if isinstance(cached, dict) and "structured" in cached:
+             return cached
     
-    print("... Retrieving context (Gemini Embeddings)...")
-    context_chunks = retrieve_chunks(query.query, query.book_id)
+    log_event("Retrieving context (Gemini Embeddings)...")
+    context_records = retrieve_chunk_records(query.query, query.book_id, page=query.page, chapter=query.chapter)
+    context_chunks = [record["text"] for record in context_records]
     
     if not context_chunks:
-        print("!!! No context found. Using static fallback. !!!")
+        log_event("No context found. Using static fallback.", logging.WARNING)
         return get_smart_fallback_prompt(query.query, query.lang)
     else:
-        print(f"Found {len(context_chunks)} chunks. Using Dual-Output RAG prompt.")
-        prompt = get_dual_output_prompt(query.query, context_chunks, query.lang)
+        log_event(f"Found {len(context_chunks)} chunks. Using Dual-Output RAG prompt.")
+        prompt, prompt_stats = build_chat_prompt(query.query, context_records, query.lang)
+        log_event(f"Prompt context: {prompt_stats['context_tokens']} tokens "
+                  f"(saved ~{prompt_stats['context_tokens_saved']} of {prompt_stats['context_tokens_naive']}).")
 
     try:
-        print(">>> Level 2: Calling Gemini Flash API (Chat) >>>")
-        response = gemini_chat_model.generate_content(prompt)
-        
-        print("Parsing LLM JSON response...")
-        json_text = re.sub(r"^```json\s*|\s*```$", "", response.text.strip(), flags=re.MULTILINE)
-        answer_json = json.loads(json_text)
+        answer_json = None
+        for attempt in range(2):
+            log_event(f"Level 2: Calling Gemini Flash API (Chat, attempt {attempt + 1})")
+            with track_stage("generate"):
+                response = get_chat_model().generate_content(
+                    prompt, generation_config=json_generation_config(CHAT_ANSWER_SCHEMA)
+                )
+            record_llm_usage(response, "chat")
+            
+            log_event("Parsing LLM JSON response...")
+            try:
+                with track_stage("json_parse"):
+                    answer_json = parse_llm_json_object(response.text, required_keys=("structured", "speech"))
+                break
+            except ValueError as e:
+                log_event(f"Chat JSON invalid ({e}). Retrying once.", logging.WARNING)
+                metrics.inc("llm_json_repair_requests_total", help_text="Follow-up requests for missing JSON items.")
+        if answer_json is None:
+            raise ValueError("LLM returned invalid JSON twice.")
+        answer_json["sources"] = get_chunk_sources(context_records)
         
         chat_cache[cache_key] = answer_json
-        print(f"Gemini Answer (Structured): {answer_json['structured'][:50]}...")
+        log_event(f"Gemini Answer (Structured): {answer_json['structured'][:50]}...")
         
         return answer_json
         
     except Exception as e:
-        print(f"!!! LLM or JSON Parsing Failed: {e} !!!")
-        print(f"Failed Response Text: {response.text if 'response' in locals() else 'N/A'}")
+        log_event(f"LLM or JSON Parsing Failed: {e}", logging.ERROR)
+        log_event(f"Failed Response Text: {response.text if 'response' in locals() else 'N/A'}", logging.ERROR)
         error_json = {"structured": "Sorry, an error occurred on the server.", "speech": "Sorry, an error occurred on the server."}
         if query.lang == 'th-TH':
             error_json = {"structured": "ขออภัยค่ะ เกิดข้อผิดพลาดบนเซิร์ฟเวอร์", "speech": "ขออภัยค่ะ เกิดข้อผิดพลาดบนเซิร์ฟเวอร์"}
         return error_json
 
+# --- API 2b: Batch Chat (several questions, one call) ---
+BATCH_MAX_QUESTIONS = 20
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))
+
+class BatchChatQuery(BaseModel):
+    book_id: str
+    lang: str
+    queries: List[str]
+    page: Optional[int] = None
+    chapter: Optional[int] = None
+
+@app.post("/chat-batch")
+def batch_chat(request: BatchChatQuery):
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries cannot be empty.")
+    if len(request.queries) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_QUESTIONS} questions per request.")
+    log_event(f"Batch Chat: {len(request.queries)} questions for {request.book_id}")
+
+    queries = [ChatQuery(query=q, book_id=request.book_id, lang=request.lang, page=request.page, chapter=request.chapter)
+               for q in request.queries]
+    # Cached answers are returned as-is; only the misses go to the worker pool.
+    answers = []
+    misses = []
+    for i, q in enumerate(queries):
+        cached = chat_cache.get(chat_cache_key(q))
+        if isinstance(cached, dict) and "structured" in cached:
+            record_cache("chat", True)
+            answers.append(cached)
+        else:
+            # final_chat records the miss itself.
+            answers.append(None)
+            misses.append(i)
+    if misses:
+        with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as pool:
+            # The context is copied here, on the request thread, so the request ID
+            # follows each question onto its worker thread. One copy per task:
+            # a Context cannot be entered by two threads at once.
+            futures = [pool.submit(contextvars.copy_context().run, final_chat, queries[i]) for i in misses]
+            for i, future in zip(misses, futures):
+                answers[i] = future.result()
+    log_event(f"Batch Chat: {len(queries) - len(misses)} cached, {len(misses)} generated.")
+    return {"book_id": request.book_id, "answers": [
+        {"query": q, "answer": answer} for q, answer in zip(request.queries, answers)
+    ]}
+
 # --- API 3: The "Read" Mode (Get Page) ---
 @app.get("/book-page/{book_id}/{page_num}")
 async def get_book_page(book_id: str, page_num: int):
@@ -415,15 +1515,40 @@ async def get_book_page(book_id: str, page_num: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- API 3b: Batch Read (Page Range) ---
+BATCH_MAX_PAGES = 50
+
+@app.get("/book-pages/{book_id}")
+async def get_book_pages(book_id: str, start: int = 1, end: Optional[int] = None):
+    page_dir = os.path.join(INGEST_PAGE_CACHE_DIR, book_id)
+    if not os.path.isdir(page_dir):
+        raise HTTPException(status_code=404, detail="Book not found.")
+    end = start + BATCH_MAX_PAGES - 1 if end is None else end
+    if start < 1 or end < start:
+        raise HTTPException(status_code=400, detail="Invalid page range.")
+    if end - start + 1 > BATCH_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_PAGES} pages per request.")
+
+    total_pages = len([name for name in os.listdir(page_dir) if name.startswith("page_") and name.endswith(".txt")])
+    pages = []
+    for page_num in range(start, min(end, total_pages) + 1):
+        page_path = os.path.join(page_dir, f"page_{page_num}.txt")
+        if not os.path.exists(page_path):
+            continue
+        with open(page_path, 'r', encoding='utf-8') as f:
+            pages.append({"page_num": page_num, "text": f.read()})
+    return {"book_id": book_id, "total_pages": total_pages, "start": start, "end": min(end, total_pages), "pages": pages}
+
 # --- API 4: "Smart Summary" Helper Function (V2 - Safer) ---
 def get_text_summary_chunks(full_book_text: str) -> str:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     SAFE_CHUNK_SIZE = 200000 
     
     if len(full_book_text) < SAFE_CHUNK_SIZE: 
-        print("Text is short. Returning full text for summarization.")
+        log_event("Text is short. Returning full text for summarization.")
         return full_book_text
 
-    print("Text is long. Starting 'Map-Reduce' summarization...")
+    log_event("Text is long. Starting 'Map-Reduce' summarization...")
     
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=SAFE_CHUNK_SIZE, 
@@ -432,56 +1557,59 @@ def get_text_summary_chunks(full_book_text: str) -> str:
     chunks = text_splitter.split_text(full_book_text)
     
     summaries = []
-    print(f"Generating {len(chunks)} summary chunks...")
+    log_event(f"Generating {len(chunks)} summary chunks...")
     
     for i, chunk in enumerate(chunks):
-        print(f"  Summarizing chunk {i+1}/{len(chunks)}...")
+        log_event(f"Summarizing chunk {i+1}/{len(chunks)}...")
         try:
             prompt = f"Summarize the key events, people, and concepts in this section of the book: {chunk}"
-            response = gemini_chat_model.generate_content(prompt)
+            with track_stage("generate"):
+                response = get_chat_model().generate_content(prompt)
             summaries.append(response.text)
         except Exception as e:
-            print(f"  Warning: Could not summarize chunk {i+1}. Error: {e}")
+            log_event(f"Could not summarize chunk {i+1}. Error: {e}", logging.WARNING)
             pass 
             
     if not summaries:
-        print("  Error: No summaries were generated. Returning truncated text as fallback.")
+        log_event("No summaries were generated. Returning truncated text as fallback.", logging.ERROR)
         return full_book_text[:SAFE_CHUNK_SIZE] 
 
     combined_summary = "\n\n".join(summaries)
     
     if len(combined_summary) > SAFE_CHUNK_SIZE:
-        print(f"  Combined summaries are still long ({len(combined_summary)}). Summarizing again...")
+        log_event(f"Combined summaries are still long ({len(combined_summary)}). Summarizing again...")
         try:
             prompt = f"Summarize the following collection of summaries into one cohesive text: {combined_summary}"
-            response = gemini_chat_model.generate_content(prompt)
+            with track_stage("generate"):
+                response = get_chat_model().generate_content(prompt)
             final_summary = response.text
-            print(f"  Final 'summary of summaries' created. Length: {len(final_summary)} chars.")
+            log_event(f"Final 'summary of summaries' created. Length: {len(final_summary)} chars.")
             return final_summary
         except Exception as e:
-            print(f"  Warning: Could not summarize the combined summaries. Error: {e}")
+            log_event(f"Could not summarize the combined summaries. Error: {e}", logging.WARNING)
             return combined_summary
     else:
-        print(f"  All chunks summarized. Combined length: {len(combined_summary)} chars.")
+        log_event(f"All chunks summarized. Combined length: {len(combined_summary)} chars.")
         return combined_summary
 
 
 # --- API 5: The "Summary" Generator (MODIFIED) ---
 @app.post("/get-book-summary")
 async def get_book_summary(query: ChatQuery):
-    print(f"--- Book Summary Request: {query.book_id} ---")
+    log_event(f"Book Summary Request: {query.book_id}")
 
     summary_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{query.book_id}_{query.lang}.summary.txt")
+    record_cache("summary", os.path.exists(summary_cache_path))
     if os.path.exists(summary_cache_path):
-        print(f"Returning summary from cache: {summary_cache_path}")
+        log_event(f"Returning summary from cache: {summary_cache_path}")
         try:
             with open(summary_cache_path, 'r', encoding='utf-8') as f:
                 summary = f.read()
             return {"answer": summary}
         except Exception as e:
-            print(f"Warning: Could not read summary cache. Regenerating. Error: {e}")
+            log_event(f"Could not read summary cache. Regenerating. Error: {e}", logging.WARNING)
     
-    print("No summary cache found. Generating new summary...")
+    log_event("No summary cache found. Generating new summary...")
     full_text_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{query.book_id}.txt")
     
     if not os.path.exists(full_text_cache_path):
@@ -493,69 +1621,210 @@ async def get_book_summary(query: ChatQuery):
         
         text_to_summarize = get_text_summary_chunks(full_book_text)
 
-        prompt = f"Provide a concise, 3-paragraph final summary of the following book text (which may be a summary of chunks): {text_to_summarize}"
+        # Written directly in the target language; no separate translation round trip.
+        language = "Thai (ภาษาไทย)" if query.lang == 'th-TH' else "English"
+        prompt = f"Provide a concise, 3-paragraph final summary, written in {language}, of the following book text (which may be a summary of chunks): {text_to_summarize}"
         
-        print("Sending final summary request to Gemini...")
-        response = gemini_chat_model.generate_content(prompt)
+        log_event(f"Sending final summary request to Gemini ({language})...")
+        with track_stage("generate"):
+            response = get_chat_model().generate_content(prompt)
+        record_llm_usage(response, "summary")
         summary = response.text
-        
-        if query.lang == 'th-TH':
-            print("Translating summary to Thai...")
-            translate_prompt = f"Translate the following summary into Thai: {summary}"
-            translate_response = gemini_chat_model.generate_content(translate_prompt)
-            summary = translate_response.text
 
         try:
             with open(summary_cache_path, 'w', encoding='utf-8') as f:
                 f.write(summary)
-            print(f"Saved new summary to cache: {summary_cache_path}")
+            log_event(f"Saved new summary to cache: {summary_cache_path}")
         except Exception as e:
-            print(f"Warning: Could not save summary to cache. Error: {e}")
+            log_event(f"Could not save summary to cache. Error: {e}", logging.WARNING)
 
         return {"answer": summary}
         
     except Exception as e:
-        print(f"!!! Summary Failed: {e} !!!")
+        log_event(f"Summary Failed: {e}", logging.ERROR)
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# --- API 6: QUESTION BANK LOGIC (MODIFIED for Language) ---
+# --- API 6: QUESTION BANK LOGIC (Sharded, Incremental) ---
+# The book is split into shards of consecutive pages. Shards are generated in
+# parallel by a bounded worker pool and merged into the cached bank as each one
+# finishes, so /get-question-bank can serve a partial bank straight away.
+QB_TARGET_QUESTIONS = int(os.getenv("QB_TARGET_QUESTIONS", "50"))
+QB_SHARD_CHARS = int(os.getenv("QB_SHARD_CHARS", "60000"))
+QB_MAX_SHARDS = int(os.getenv("QB_MAX_SHARDS", "25"))
+QB_MAX_WORKERS = int(os.getenv("QB_MAX_WORKERS", "4"))
+QB_STALE_SECONDS = int(os.getenv("QB_STALE_SECONDS", "1800"))
 
-def generate_question_bank_task(book_id: str, lang: str):
-    print(f"---BACKGROUND: Starting Question Bank Generation for {book_id} (Lang: {lang}) ---")
-    bank_cache_path = os.path.join(QUESTION_BANK_CACHE_DIR, f"{book_id}_{lang}.json")
-    
-    if os.path.exists(bank_cache_path):
-        print(f"---BACKGROUND: Cache file already exists. Skipping. ---")
-        return
+def get_question_bank_lock(book_id, lang):
+    # File lock so shards finishing in different worker processes do not overwrite each other.
+    return file_lock(os.path.join(LOCK_DIR, f"qbank_{book_id}_{lang}"))
 
-    full_text_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}.txt")
-    if not os.path.exists(full_text_cache_path):
-        print(f"---BACKGROUND: FAILED. Full text cache not found for {book_id} ---")
-        return
-        
+def question_bank_paths(book_id, lang):
+    base = os.path.join(QUESTION_BANK_CACHE_DIR, f"{book_id}_{lang}")
+    return f"{base}.json", f"{base}.status.json"
+
+def read_json_file(path, default=None):
+    if not os.path.exists(path):
+        return default
     try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        log_event(f"Could not read {path}. Error: {e}", logging.WARNING)
+        return default
+
+def load_book_pages(book_id):
+    """Returns [(page_num, text), ...] from the page cache, falling back to the full-text cache."""
+    page_dir = os.path.join(INGEST_PAGE_CACHE_DIR, book_id)
+    pages = []
+    if os.path.isdir(page_dir):
+        for name in os.listdir(page_dir):
+            match = re.fullmatch(r"page_(\d+)\.txt", name)
+            if match:
+                with open(os.path.join(page_dir, name), 'r', encoding='utf-8') as f:
+                    pages.append((int(match.group(1)), f.read()))
+    if pages:
+        return sorted(pages)
+    full_text_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}.txt")
+    if os.path.exists(full_text_cache_path):
         with open(full_text_cache_path, 'r', encoding='utf-8') as f:
-            full_book_text = f.read()
-            
-        print(f"---BACKGROUND: Generating context for Question Bank... ---")
-        book_context = get_text_summary_chunks(full_book_text)
-        print(f"---BACKGROUND: Context generated. Length: {len(book_context)} chars. ---")
+            return [(1, f.read())]
+    return []
+
+def build_question_shards(pages, chapters):
+    """Groups pages into shards along chapter boundaries.
+
+    Each chapter becomes one shard; a chapter longer than the shard size is
+    split by page. Neighbouring chapters are only combined when there are more
+    chapters than QB_MAX_SHARDS.
+    """
+    total_chars = sum(len(text) for _, text in pages)
+    shard_chars = max(QB_SHARD_CHARS, -(-total_chars // QB_MAX_SHARDS))
+    pages = [(page_num, text) for page_num, text in pages if text.strip()]
+
+    groups = []
+    covered = set()
+    for chapter in chapters:
+        chapter_pages = [(n, text) for n, text in pages if chapter["page_start"] <= n <= chapter["page_end"]]
+        if chapter_pages:
+            groups.append(([chapter["title"]], chapter_pages))
+            covered.update(n for n, _ in chapter_pages)
+    # Pages no chapter claims (e.g. a full-text cache stored as page 1) still get questions.
+    leftover = [(n, text) for n, text in pages if n not in covered]
+    if leftover:
+        groups.append(([], leftover))
+        groups.sort(key=lambda group: group[1][0][0])
+
+    if len(groups) > QB_MAX_SHARDS:
+        merged = []
+        for titles, group_pages in groups:
+            group_chars = sum(len(text) for _, text in group_pages)
+            if merged and merged[-1][2] + group_chars <= shard_chars:
+                merged[-1][0].extend(titles)
+                merged[-1][1].extend(group_pages)
+                merged[-1][2] += group_chars
+            else:
+                merged.append([list(titles), list(group_pages), group_chars])
+        groups = [(titles, group_pages) for titles, group_pages, _ in merged]
+
+    shards = []
+    for titles, group_pages in groups:
+        current = []
+        current_chars = 0
+        for page_num, text in group_pages:
+            if current and current_chars + len(text) > shard_chars:
+                shards.append((titles, current))
+                current, current_chars = [], 0
+            current.append((page_num, text))
+            current_chars += len(text)
+        if current:
+            shards.append((titles, current))
+    return [{
+        "shard": i,
+        "title": ", ".join(titles),
+        "page_start": shard[0][0],
+        "page_end": shard[-1][0],
+        "text": "\n\n".join(text for _, text in shard)[:shard_chars],
+    } for i, (titles, shard) in enumerate(shards)]
+
+def allocate_counts(weights, total):
+    """Splits `total` in proportion to `weights` using the largest-remainder method."""
+    if not weights or sum(weights) <= 0:
+        return [0] * len(weights)
+    exact = [total * w / sum(weights) for w in weights]
+    counts = [int(x) for x in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: exact[i] - counts[i], reverse=True)
+    for i in by_remainder[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+def allocate_question_counts(shards, total):
+    """Splits `total` questions across shards in proportion to their text length."""
+    return allocate_counts([max(1, len(s["text"])) for s in shards], total)
+
+def allocate_difficulty_plans(counts, plan):
+    """Spreads one bank-wide difficulty plan over shards; each shard's plan sums to its count.
+
+    Rounding 40/40/20 per shard would give small shards no hard questions at all.
+    """
+    remaining = list(counts)
+    plans = [dict.fromkeys(QUESTION_DIFFICULTIES, 0) for _ in counts]
+    for difficulty in ("hard", "easy"):
+        for i, n in enumerate(allocate_counts(remaining, plan.get(difficulty, 0))):
+            n = min(n, remaining[i])
+            plans[i][difficulty] = n
+            remaining[i] -= n
+    for i, n in enumerate(remaining):
+        plans[i]["medium"] = n
+    return plans
+
+def question_key(question_text):
+    return re.sub(r"[\W_]+", " ", question_text.casefold()).strip()
+
+def merge_question_bank(existing, new_items):
+    """Appends new questions, dropping duplicates, and orders the bank so difficulties stay interleaved."""
+    seen = {question_key(q["question"]) for q in existing}
+    merged = list(existing)
+    for item in new_items:
+        key = question_key(item["question"])
+        if key and key not in seen:
+            seen.add(key)
+            merged.append(item)
+
+    # Interleave 2 easy : 2 medium : 1 hard so any prefix of a partial bank is balanced.
+    queues = {d: [q for q in merged if q["difficulty"] == d] for d in QUESTION_DIFFICULTIES}
+    pattern = ["easy", "medium", "easy", "medium", "hard"]
+    balanced = []
+    while any(queues.values()):
+        for difficulty in pattern:
+            if queues[difficulty]:
+                balanced.append(queues[difficulty].pop(0))
+    return balanced
+
+def question_bank_lang_prompt(lang):
+    if lang == 'th-TH':
+        return "The questions and options must be in Thai (ภาษาไทย). Keep the difficulty value in English (easy, medium, hard)."
+    return "The questions and options must be in English."
 
-        if lang == 'th-TH':
-            lang_prompt = "The questions, options, and difficulty must be in Thai (ภาษาไทย)."
-        else:
-            lang_prompt = "The questions, options, and difficulty must be in English."
+def generate_shard_questions(shard, count, lang, exclude_questions=(), plan=None):
+    lang_prompt = question_bank_lang_prompt(lang)
+
+    section = f"{shard['title']}, " if shard.get("title") else ""
 
-        prompt = f"""
-        You are an expert curriculum designer. Read the following text, which is a comprehensive summary of a book.
-        Your Task: Generate a comprehensive question bank of 50 multiple-choice questions based *only* on this text.
-        The questions must cover a wide range of topics.
-        Include a mix of difficulties: 20 easy, 20 medium, and 10 hard.
+    def build_prompt(missing, plan, already_generated):
+        excluded = list(exclude_questions) + list(already_generated)
+        exclude_prompt = ""
+        if excluded:
+            exclude_list = "\n".join(f"- {q}" for q in excluded)
+            exclude_prompt = f"These questions already exist. Do NOT repeat them:\n{exclude_list}\n"
+        return f"""
+        You are an expert curriculum designer. Read the following section of a book ({section}pages {shard['page_start']}-{shard['page_end']}).
+        Your Task: Generate {missing} multiple-choice questions based *only* on this section.
+        The questions must cover a wide range of topics from the section.
+        Include a mix of difficulties: {plan['easy']} easy, {plan['medium']} medium, and {plan['hard']} hard.
         {lang_prompt}
-        
-        CRITICAL: You MUST return your answer as a JSON array *only*.
-        Each object in the array must have this *exact* structure:
+        {exclude_prompt}
+        Return a JSON array. Each object must have this *exact* structure:
         {{
             "question": "The text of the question...",
             "options": ["Option A", "Option B", "Option C", "Option D"],
@@ -563,88 +1832,492 @@ def generate_question_bank_task(book_id: str, lang: str):
             "difficulty": "easy" 
         }}
 
-        BOOK TEXT (SUMMARY):
-        {book_context}
+        BOOK SECTION:
+        {shard['text']}
         """
-        
-        print(f"---BACKGROUND: Sending large prompt to Gemini for {book_id}... This will take minutes. ---")
-        response = gemini_chat_model.generate_content(prompt)
-        
-        json_text = re.sub(r"^```json\s*|\s*```$", "", response.text.strip(), flags=re.MULTILINE)
-        
-        print(f"---BACKGROUND: Parsing question bank JSON for {book_id}... ---")
-        question_bank_data = json.loads(json_text)
-        
-        with open(bank_cache_path, 'w', encoding='utf-8') as f:
-            json.dump(question_bank_data, f, indent=4, ensure_ascii=False) # ensure_ascii=False for Thai
-        print(f"---BACKGROUND: SUCCESS! Saved new question bank to cache: {bank_cache_path} ---")
-            
+
+    questions = generate_question_list(build_prompt, count, label=f"[shard {shard['shard']}]", target_plan=plan)
+    for q in questions:
+        q["shard"] = shard["shard"]
+    return questions
+
+def save_question_shard(book_id, lang, shard_index, questions, status_update):
+    bank_cache_path, status_path = question_bank_paths(book_id, lang)
+    with get_question_bank_lock(book_id, lang):
+        bank = read_json_file(bank_cache_path, default=[])
+        bank = merge_question_bank(bank, questions)
+        write_json_atomic(bank_cache_path, bank)
+
+        bank_status = read_json_file(status_path, default={})
+        if shard_index is not None and shard_index not in bank_status.get("shards_done", []):
+            bank_status.setdefault("shards_done", []).append(shard_index)
+        bank_status.update(status_update)
+        bank_status["question_count"] = len(bank)
+        bank_status["updated_at"] = time.time()
+        write_json_atomic(status_path, bank_status)
+    return len(bank)
+
+def update_question_bank_status(book_id, lang, **fields):
+    _, status_path = question_bank_paths(book_id, lang)
+    with get_question_bank_lock(book_id, lang):
+        bank_status = read_json_file(status_path, default={})
+        bank_status.update(fields)
+        bank_status["updated_at"] = time.time()
+        write_json_atomic(status_path, bank_status)
+
+def is_question_bank_generating(bank_status):
+    # A "generating" status that has not been touched for a long time was left by a dead worker.
+    return (bank_status.get("state") == "generating"
+            and time.time() - bank_status.get("updated_at", 0) < QB_STALE_SECONDS)
+
+def run_question_shards(book_id, lang, jobs, mark_done=True):
+    """Runs (shard, count, exclude_questions, plan) jobs on the worker pool; returns the failed shard indexes.
+
+    mark_done records finished shards in shards_done so a regeneration skips them.
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=QB_MAX_WORKERS) as pool:
+        # One context copy per job keeps the request ID on the shard workers' log lines.
+        futures = {pool.submit(contextvars.copy_context().run, generate_shard_questions, shard, count, lang,
+                               exclude, plan): shard
+                   for shard, count, exclude, plan in jobs}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                questions = future.result()
+            except Exception as e:
+                log_event(f"Shard {shard['shard']} failed for {book_id}: {e}", logging.WARNING)
+                failed.append(shard["shard"])
+                continue
+            if not questions:
+                failed.append(shard["shard"])
+                continue
+            total = save_question_shard(book_id, lang, shard["shard"] if mark_done else None, questions, {})
+            log_event(f"Shard {shard['shard']} (pages {shard['page_start']}-{shard['page_end']}) "
+                      f"added {len(questions)} questions. Bank now has {total}.")
+    return failed
+
+def generate_question_bank_task(book_id: str, lang: str):
+    log_event(f"Starting Question Bank Generation for {book_id} (Lang: {lang})")
+    _, status_path = question_bank_paths(book_id, lang)
+    bank_status = read_json_file(status_path, default={})
+    if bank_status.get("state") == "complete":
+        log_event("Question bank already complete. Skipping.")
+        return
+
+    pages = load_book_pages(book_id)
+    if not pages:
+        log_event(f"FAILED. Page / full text cache not found for {book_id}", logging.ERROR)
+        update_question_bank_status(book_id, lang, state="failed", error="Book text cache not found.")
+        return
+
+    try:
+        shards = build_question_shards(pages, get_book_chapters(book_id))
+        counts = allocate_question_counts(shards, QB_TARGET_QUESTIONS)
+        plans = allocate_difficulty_plans(counts, difficulty_plan(QB_TARGET_QUESTIONS))
+        shards_done = set(bank_status.get("shards_done", []))
+        jobs = [(shard, count, (), plan) for shard, count, plan in zip(shards, counts, plans)
+                if count > 0 and shard["shard"] not in shards_done]
+        update_question_bank_status(book_id, lang, state="generating", shards_total=len(shards),
+                                    shards_done=sorted(shards_done), error=None)
+        log_event(f"{len(jobs)} of {len(shards)} shards to generate with {QB_MAX_WORKERS} workers.")
+
+        failed = run_question_shards(book_id, lang, jobs)
+        if failed:
+            update_question_bank_status(book_id, lang, state="partial", failed_shards=sorted(failed))
+            log_event(f"Question bank for {book_id} is partial. Failed shards: {sorted(failed)}", logging.WARNING)
+        else:
+            update_question_bank_status(book_id, lang, state="complete", failed_shards=[])
+            log_event(f"SUCCESS! Question bank complete for {book_id}.")
+
     except Exception as e:
-        print(f"---BACKGROUND: !!! FATAL ERROR Generating Question Bank for {book_id}: {e} !!!")
-        print(f"Failed Response Text: {response.text if 'response' in locals() else 'N/A'}")
+        log_event(f"FATAL ERROR Generating Question Bank for {book_id}: {e}", logging.ERROR)
+        update_question_bank_status(book_id, lang, state="failed", error=str(e))
+
+def append_question_bank_task(book_id: str, lang: str, count: int):
+    log_event(f"Appending {count} questions to bank for {book_id} (Lang: {lang})")
+    bank_cache_path, status_path = question_bank_paths(book_id, lang)
+    pages = load_book_pages(book_id)
+    if not pages:
+        log_event(f"FAILED. Page / full text cache not found for {book_id}", logging.ERROR)
+        return
+    try:
+        shards = build_question_shards(pages, get_book_chapters(book_id))
+        bank = read_json_file(bank_cache_path, default=[])
+        existing_by_shard = {}
+        for q in bank:
+            existing_by_shard.setdefault(q.get("shard"), []).append(q["question"])
+
+        # New questions go to the shards that are furthest below their fair share first.
+        fair_share = allocate_question_counts(shards, len(bank) + count)
+        deficits = [max(0, c - len(existing_by_shard.get(s["shard"], []))) for s, c in zip(shards, fair_share)]
+        if sum(deficits) > 0:
+            extra = allocate_counts(deficits, count)
+        else:
+            extra = allocate_question_counts(shards, count)
+        # Balance difficulties over the whole bank, existing questions included.
+        plan = fit_difficulty_plan(difficulty_plan(len(bank) + count, bank), count)
+        plans = allocate_difficulty_plans(extra, plan)
+        jobs = [(shard, n, existing_by_shard.get(shard["shard"], []), shard_plan)
+                for shard, n, shard_plan in zip(shards, extra, plans) if n > 0]
+
+        update_question_bank_status(book_id, lang, state="generating")
+        # Appended questions do not finish a shard, so shards that failed during
+        # generation stay failed and /generate-question-bank can still retry them.
+        failed = run_question_shards(book_id, lang, jobs, mark_done=False)
+        earlier_failed = read_json_file(status_path, default={}).get("failed_shards", [])
+        failed = sorted(set(earlier_failed) | set(failed))
+        update_question_bank_status(book_id, lang, state="partial" if failed else "complete",
+                                    failed_shards=failed)
+        log_event(f"Append finished for {book_id}.")
+    except Exception as e:
+        log_event(f"FATAL ERROR Appending to Question Bank for {book_id}: {e}", logging.ERROR)
+        update_question_bank_status(book_id, lang, state="failed", error=str(e))
 
 @app.post("/generate-question-bank/{book_id}/{lang}")
 async def start_question_bank_generation(book_id: str, lang: str, background_tasks: BackgroundTasks):
-    bank_cache_path = os.path.join(QUESTION_BANK_CACHE_DIR, f"{book_id}_{lang}.json")
-    if os.path.exists(bank_cache_path):
+    bank_cache_path, status_path = question_bank_paths(book_id, lang)
+    bank_status = read_json_file(status_path, default={})
+    if is_question_bank_generating(bank_status):
+        return {"message": "Question bank generation is already running. Questions appear as they are ready."}
+    if os.path.exists(bank_cache_path) and bank_status.get("state", "complete") == "complete":
         return {"message": "Question bank already exists."}
         
-    print(f"Adding question bank generation task for {book_id} (Lang: {lang}) to background.")
+    log_event(f"Adding question bank generation task for {book_id} (Lang: {lang}) to background.")
+    update_question_bank_status(book_id, lang, state="generating")
     background_tasks.add_task(generate_question_bank_task, book_id, lang)
     
-    return {"message": "Question bank generation has started. This may take 5-10 minutes."}
+    return {"message": "Question bank generation has started. Questions appear as each section finishes."}
+
+@app.post("/append-question-bank/{book_id}/{lang}")
+async def start_question_bank_append(book_id: str, lang: str, background_tasks: BackgroundTasks, count: int = 10):
+    bank_cache_path, status_path = question_bank_paths(book_id, lang)
+    if not os.path.exists(bank_cache_path):
+        raise HTTPException(status_code=404, detail="Question bank has not been generated yet.")
+    if is_question_bank_generating(read_json_file(status_path, default={})):
+        raise HTTPException(status_code=429, detail="Question bank generation is already running.")
+    if not 1 <= count <= 100:
+        raise HTTPException(status_code=400, detail="count must be between 1 and 100.")
+
+    update_question_bank_status(book_id, lang, state="generating")
+    background_tasks.add_task(append_question_bank_task, book_id, lang, count)
+    return {"message": f"Adding {count} questions to the question bank."}
+
+@app.get("/question-bank-status/{book_id}/{lang}")
+async def get_question_bank_status(book_id: str, lang: str):
+    bank_cache_path, status_path = question_bank_paths(book_id, lang)
+    bank_status = read_json_file(status_path)
+    if bank_status is None:
+        if not os.path.exists(bank_cache_path):
+            raise HTTPException(status_code=404, detail="Question bank has not been generated yet.")
+        # Bank generated before sharding was introduced.
+        bank_status = {"state": "complete", "question_count": len(read_json_file(bank_cache_path, default=[]))}
+    return bank_status
 
 
 @app.get("/get-question-bank/{book_id}/{lang}")
 async def get_question_bank(book_id: str, lang: str):
     bank_cache_path = os.path.join(QUESTION_BANK_CACHE_DIR, f"{book_id}_{lang}.json")
     
+    record_cache("question_bank", os.path.exists(bank_cache_path))
     if not os.path.exists(bank_cache_path):
         raise HTTPException(status_code=404, detail="Question bank has not been generated yet.")
         
     try:
         with open(bank_cache_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-        return data
+        # The bank may still be growing; clients can poll /question-bank-status for progress.
+        bank_status = read_json_file(question_bank_paths(book_id, lang)[1], default={})
+        return JSONResponse(content=data, headers={"X-Question-Bank-State": bank_status.get("state", "complete")})
     except Exception as e:
-        print(f"Error reading question bank cache: {e}")
+        log_event(f"Error reading question bank cache: {e}", logging.ERROR)
         raise HTTPException(status_code=500, detail="Could not read question bank cache file.")
 
 
 # --- API 7: Text-to-Speech (TTS) using gTTS ---
+def synthesize_audio_bytes(text: str, lang: str) -> bytes:
+    from gtts import gTTS
+    lang_code = lang.split('-')[0]
+    with track_stage("tts"):
+        tts = gTTS(text=text, lang=lang_code)
+        audio_buffer = io.BytesIO()
+        tts.write_to_fp(audio_buffer)
+    return audio_buffer.getvalue()
+
 @app.post("/synthesize-speech")
 async def synthesize_speech(request: TTSRequest):
-    print(f"--- gTTS Request: {request.text[:30]}... Lang: {request.lang} ---")
+    log_event(f"gTTS Request: {request.text[:30]}... Lang: {request.lang}")
     
     try:
-        lang_code = request.lang.split('-')[0]
-        
-        tts = gTTS(text=request.text, lang=lang_code)
+        audio_buffer = io.BytesIO(synthesize_audio_bytes(request.text, request.lang))
         
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
-        
-        print("--- gTTS Success, streaming audio back ---")
+        log_event("gTTS Success, streaming audio back")
         return StreamingResponse(audio_buffer, media_type="audio/mpeg")
 
     except Exception as e:
-        print(f"!!! gTTS Failed: {e} !!!")
+        log_event(f"gTTS Failed: {e}", logging.ERROR)
         raise HTTPException(status_code=500, detail=f"gTTS failed: {e}")
 
+
+# --- API 7b: Precomputed Page Audio & Chapter Summaries ---
+# After ingest (when PRECOMPUTE_ENABLED=1) or on demand, page audio and chapter
+# summaries are rendered into the cache for every PRECOMPUTE_LANGS language, so
+# reading a book aloud is a plain file stream instead of a TTS round trip.
+PRECOMPUTE_ENABLED = os.getenv("PRECOMPUTE_ENABLED", "0") == "1"
+PRECOMPUTE_LANGS = [l.strip() for l in os.getenv("PRECOMPUTE_LANGS", "en-US,th-TH").split(",") if l.strip()]
+PRECOMPUTE_MAX_WORKERS = int(os.getenv("PRECOMPUTE_MAX_WORKERS", "2"))
+PRECOMPUTE_TASK_DELAY = float(os.getenv("PRECOMPUTE_TASK_DELAY", "0.5"))  # seconds each worker rests between items
+PRECOMPUTE_STALE_SECONDS = int(os.getenv("PRECOMPUTE_STALE_SECONDS", "1800"))
+# Languages the cache may hold files for; `lang` is part of the cache file paths.
+SUPPORTED_LANGS = sorted({"en-US", "th-TH", *PRECOMPUTE_LANGS})
+CHAPTER_FALLBACK_PAGES = 20
+CHAPTER_SUMMARY_MAX_CHARS = 200000
+
+def check_lang(lang):
+    if lang not in SUPPORTED_LANGS:
+        raise HTTPException(status_code=400, detail=f"Unsupported lang. Use one of: {', '.join(SUPPORTED_LANGS)}.")
+
+def page_audio_path(book_id, lang, page_num):
+    return os.path.join(AUDIO_CACHE_DIR, book_id, lang, f"page_{page_num}.mp3")
+
+def chapter_summary_path(book_id, lang, chapter_index):
+    # Ends in .summary.txt so the existing rescan / delete cleanup removes it.
+    return os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}_{lang}_chapter_{chapter_index}.summary.txt")
+
+def precompute_status_path(book_id):
+    return os.path.join(AUDIO_CACHE_DIR, book_id, "status.json")
+
+def save_book_chapters(book_id, toc, page_count):
+    """Stores level-1 PDF outline entries as chapters with page spans in the page cache.
+
+    Outline entries that start on the same page (e.g. "Part I" and "Chapter 1")
+    are merged into the first one. If the result does not cover every page
+    exactly once, fixed-size page groups are stored instead.
+    """
+    entries = []
+    for level, title, page, *_ in sorted(toc, key=lambda e: e[2]):
+        if level != 1 or not 1 <= page <= page_count:
+            continue
+        if entries and entries[-1][1] == page:
+            continue
+        entries.append((title.strip(), page))
+    chapters = []
+    for i, (title, page_start) in enumerate(entries):
+        page_end = entries[i + 1][1] - 1 if i + 1 < len(entries) else page_count
+        chapters.append({"title": title or f"Chapter {len(chapters) + 1}", "page_start": page_start,
+                         "page_end": page_end})
+    if chapters and chapters[0]["page_start"] > 1:
+        chapters.insert(0, {"title": "Front matter", "page_start": 1, "page_end": chapters[0]["page_start"] - 1})
+    for i, chapter in enumerate(chapters):
+        chapter["chapter"] = i
+    if chapters and not chapters_cover_pages(chapters, page_count):
+        log_event(f"PDF outline of {book_id} does not cover pages 1-{page_count}. Using page groups.", logging.WARNING)
+        chapters = fallback_chapters(page_count)
+    os.makedirs(os.path.join(INGEST_PAGE_CACHE_DIR, book_id), exist_ok=True)
+    write_json_atomic(os.path.join(INGEST_PAGE_CACHE_DIR, book_id, "chapters.json"), chapters)
+    log_event(f"Saved {len(chapters)} chapters from the PDF outline for {book_id}.")
+    return chapters
+
+def chapters_cover_pages(chapters, page_count):
+    """True if the chapters are contiguous and span pages 1..page_count with no gap or overlap."""
+    next_page = 1
+    for chapter in chapters:
+        if chapter["page_start"] != next_page or chapter["page_end"] < chapter["page_start"]:
+            return False
+        next_page = chapter["page_end"] + 1
+    return next_page == page_count + 1
+
+def get_book_chapters(book_id):
+    """Returns the saved chapters, or fixed-size page groups when the PDF had no outline."""
+    chapters = read_json_file(os.path.join(INGEST_PAGE_CACHE_DIR, book_id, "chapters.json"))
+    if chapters:
+        return chapters
+    page_nums = [page_num for page_num, _ in load_book_pages(book_id)]
+    return fallback_chapters(max(page_nums, default=0))
+
+def fallback_chapters(last_page):
+    return [{"chapter": i, "title": f"Pages {start}-{min(start + CHAPTER_FALLBACK_PAGES - 1, last_page)}",
+             "page_start": start, "page_end": min(start + CHAPTER_FALLBACK_PAGES - 1, last_page)}
+            for i, start in enumerate(range(1, last_page + 1, CHAPTER_FALLBACK_PAGES))]
+
+def render_page_audio(book_id, lang, page_num, text):
+    """Writes the page's audio file if missing; returns its path, or None for a blank page."""
+    path = page_audio_path(book_id, lang, page_num)
+    if os.path.exists(path):
+        return path
+    if not text.strip():
+        return None
+    audio = synthesize_audio_bytes(text, lang)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Precompute and an on-demand request may render the same page at once; the last rename wins.
+    write_file_atomic(path, audio)
+    return path
+
+def generate_chapter_summary(book_id, lang, chapter, pages_by_num=None):
+    path = chapter_summary_path(book_id, lang, chapter["chapter"])
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    if pages_by_num is None:
+        pages_by_num = dict(load_book_pages(book_id))
+    chapter_text = "\n\n".join(pages_by_num.get(n, "") for n in range(chapter["page_start"], chapter["page_end"] + 1))
+    if not chapter_text.strip():
+        return ""
+    language = "Thai (ภาษาไทย)" if lang == 'th-TH' else "English"
+    prompt = (f"Write a concise 1-paragraph summary of the chapter \"{chapter['title']}\" "
+              f"(pages {chapter['page_start']}-{chapter['page_end']}) of a book, in {language}. "
+              f"Chapter text: {chapter_text[:CHAPTER_SUMMARY_MAX_CHARS]}")
+    with track_stage("generate"):
+        summary = get_chat_model().generate_content(prompt).text
+    write_file_atomic(path, summary.encode('utf-8'))
+    return summary
+
+def update_precompute_status(book_id, only_if_idle=False, **fields):
+    """Merges `fields` into the status file under the precompute lock.
+
+    With only_if_idle, nothing is written (and None is returned) while another
+    live run is in progress, so two runs for one book cannot start at once.
+    """
+    path = precompute_status_path(book_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with file_lock(os.path.join(LOCK_DIR, f"precompute_{book_id}")):
+        precompute_status = read_json_file(path, default={})
+        if only_if_idle and is_precompute_running(precompute_status):
+            return None
+        precompute_status.update(fields)
+        precompute_status["updated_at"] = time.time()
+        write_json_atomic(path, precompute_status)
+        return precompute_status
+
+def is_precompute_running(precompute_status):
+    # A "running" status that has not been touched for a long time was left by a dead worker.
+    return (precompute_status.get("state") == "running"
+            and time.time() - precompute_status.get("updated_at", 0) < PRECOMPUTE_STALE_SECONDS)
+
+def precompute_book_task(book_id: str, langs=None):
+    langs = langs or PRECOMPUTE_LANGS
+    log_event(f"Precomputing audio & chapter summaries for {book_id} ({', '.join(langs)})")
+    pages = load_book_pages(book_id)
+    if not pages:
+        update_precompute_status(book_id, state="failed", error="Page cache not found.")
+        return
+    pages_by_num = dict(pages)
+    chapters = get_book_chapters(book_id)
+
+    jobs = [("audio", lang, page_num) for lang in langs for page_num, _ in pages]
+    jobs += [("summary", lang, chapter) for lang in langs for chapter in chapters]
+    counters = {"audio_done": {lang: 0 for lang in langs}, "summaries_done": {lang: 0 for lang in langs}}
+    errors = []
+    if update_precompute_status(book_id, only_if_idle=True, state="running", langs=langs, pages_total=len(pages),
+                                chapters_total=len(chapters), error=None, **counters) is None:
+        log_event(f"Precompute for {book_id} is already running. Skipping.")
+        return
+
+    def run_job(job):
+        kind, lang, target = job
+        try:
+            if kind == "audio":
+                render_page_audio(book_id, lang, target, pages_by_num[target])
+            else:
+                generate_chapter_summary(book_id, lang, target, pages_by_num)
+        finally:
+            if PRECOMPUTE_TASK_DELAY:
+                time.sleep(PRECOMPUTE_TASK_DELAY)
+        return job
+
+    with ThreadPoolExecutor(max_workers=PRECOMPUTE_MAX_WORKERS) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, run_job, job) for job in jobs]
+        for i, future in enumerate(as_completed(futures), start=1):
+            try:
+                kind, lang, _ = future.result()
+                counters["audio_done" if kind == "audio" else "summaries_done"][lang] += 1
+            except Exception as e:
+                errors.append(str(e))
+                log_event(f"Precompute item failed for {book_id}: {e}", logging.WARNING)
+            if i % 20 == 0 or i == len(futures):
+                update_precompute_status(book_id, **counters)
+
+    update_precompute_status(book_id, state="complete" if not errors else "partial",
+                             errors=errors[-20:], **counters)
+    log_event(f"Precompute finished for {book_id} ({len(errors)} errors).")
+
+@app.post("/precompute/{book_id}")
+async def start_precompute(book_id: str, background_tasks: BackgroundTasks):
+    if not os.path.isdir(os.path.join(INGEST_PAGE_CACHE_DIR, book_id)):
+        raise HTTPException(status_code=404, detail="Book page cache not found.")
+    if is_precompute_running(read_json_file(precompute_status_path(book_id), default={})):
+        return {"message": f"Precompute is already running for {book_id}."}
+    background_tasks.add_task(precompute_book_task, book_id)
+    return {"message": f"Precompute started for {book_id}."}
+
+@app.get("/precompute-status/{book_id}")
+async def get_precompute_status(book_id: str):
+    precompute_status = read_json_file(precompute_status_path(book_id))
+    if precompute_status is None:
+        return {"state": "not_started"}
+    return precompute_status
+
+@app.get("/book-page-audio/{book_id}/{page_num}")
+def get_book_page_audio(book_id: str, page_num: int, lang: str = "en-US"):
+    check_lang(lang)
+    path = page_audio_path(book_id, lang, page_num)
+    record_cache("page_audio", os.path.exists(path))
+    if not os.path.exists(path):
+        page_path = os.path.join(INGEST_PAGE_CACHE_DIR, book_id, f"page_{page_num}.txt")
+        if not os.path.exists(page_path):
+            raise HTTPException(status_code=404, detail="Page not found.")
+        with open(page_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        try:
+            path = render_page_audio(book_id, lang, page_num, text)
+        except Exception as e:
+            log_event(f"gTTS Failed: {e}", logging.ERROR)
+            raise HTTPException(status_code=500, detail=f"gTTS failed: {e}")
+        if path is None:
+            raise HTTPException(status_code=404, detail="Page has no text to read.")
+    return FileResponse(path, media_type="audio/mpeg")
+
+@app.get("/book-chapters/{book_id}")
+def get_chapters(book_id: str):
+    chapters = get_book_chapters(book_id)
+    if not chapters:
+        raise HTTPException(status_code=404, detail="Book not found.")
+    return {"book_id": book_id, "chapters": chapters}
+
+@app.get("/chapter-summary/{book_id}/{chapter_index}")
+def get_chapter_summary(book_id: str, chapter_index: int, lang: str = "en-US"):
+    check_lang(lang)
+    chapters = get_book_chapters(book_id)
+    if not 0 <= chapter_index < len(chapters):
+        raise HTTPException(status_code=404, detail="Chapter not found.")
+    record_cache("chapter_summary", os.path.exists(chapter_summary_path(book_id, lang, chapter_index)))
+    try:
+        return {"chapter": chapters[chapter_index], "answer": generate_chapter_summary(book_id, lang, chapters[chapter_index])}
+    except Exception as e:
+        log_event(f"Chapter Summary Failed: {e}", logging.ERROR)
+        raise HTTPException(status_code=500, detail=str(e))
+
 # --- 8. ADMIN API ENDPOINTS ---
 
 @app.get("/library")
-def get_library_data():
-    global library_data
+def get_library_data(include_summaries: bool = False, lang: str = "en-US"):
+    library = refresh_library()
     books_with_status = {}
-    for book_id, metadata in library_data["books"].items():
+    for book_id, metadata in library["books"].items():
         pdf_path = os.path.join(UPLOAD_DIR, book_id)
-        metadata["is_scanned"] = not os.path.exists(pdf_path)
-        books_with_status[book_id] = metadata
+        books_with_status[book_id] = dict(metadata, is_scanned=not os.path.exists(pdf_path))
+        if include_summaries:
+            # Only already-cached summaries are attached; nothing is generated here.
+            summary_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}_{lang}.summary.txt")
+            summary = None
+            if os.path.exists(summary_cache_path):
+                with open(summary_cache_path, 'r', encoding='utf-8') as f:
+                    summary = f.read()
+            record_cache("summary", summary is not None)
+            books_with_status[book_id]["summary"] = summary
         
     return JSONResponse(content={
-        "categories": library_data["categories"],
+        "categories": library["categories"],
         "books": books_with_status
     })
 
@@ -661,17 +2334,17 @@ async def upload_book(
     file_path = os.path.join(UPLOAD_DIR, file.filename)
     book_id = file.filename
     
-    if book_id in library_data["books"]:
+    if book_id in refresh_library()["books"]:
         raise HTTPException(status_code=400, detail=f"Book ID '{book_id}' already exists. Delete it first to re-upload.")
 
     try:
         with open(file_path, "wb") as buffer:
             buffer.write(await file.read())
-        print(f"File saved to: {file_path}")
+        log_event(f"File saved to: {file_path}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
         
-    print(f"Adding ingest job for {book_id} to background tasks.")
+    log_event(f"Adding ingest job for {book_id} to background tasks.")
     background_tasks.add_task(process_and_ingest_pdf, file_path, book_id, category_id, display_name)
     
     return {"message": f"Upload successful. '{book_id}' is being ingested. This may take 5-15 minutes."}
@@ -682,32 +2355,30 @@ class CategoryRequest(BaseModel):
 
 @app.post("/category")
 def add_category(request: CategoryRequest):
-    global library_data
     cat_id = request.category_id.lower().strip().replace(" ", "-")
     if not cat_id:
         raise HTTPException(status_code=400, detail="Category ID cannot be empty.")
-    if cat_id in library_data["categories"]:
-        raise HTTPException(status_code=400, detail="Category ID already exists.")
-    
-    library_data["categories"][cat_id] = request.display_name
-    save_library()
-    return JSONResponse(content=library_data)
+    with library_transaction() as library:
+        if cat_id in library["categories"]:
+            raise HTTPException(status_code=400, detail="Category ID already exists.")
+        
+        library["categories"][cat_id] = request.display_name
+    return JSONResponse(content=library)
 
 @app.delete("/category/{category_id}")
 def delete_category(category_id: str):
-    global library_data
     if category_id == "uncategorized":
         raise HTTPException(status_code=400, detail="Cannot delete the 'uncategorized' category.")
-    if category_id not in library_data["categories"]:
-        raise HTTPException(status_code=404, detail="Category not found.")
-    
-    for book_id, metadata in library_data["books"].items():
-        if metadata["category"] == category_id:
-            metadata["category"] = "uncategorized"
-            
-    del library_data["categories"][category_id]
-    save_library()
-    return JSONResponse(content=library_data)
+    with library_transaction() as library:
+        if category_id not in library["categories"]:
+            raise HTTPException(status_code=404, detail="Category not found.")
+        
+        for book_id, metadata in library["books"].items():
+            if metadata["category"] == category_id:
+                metadata["category"] = "uncategorized"
+                
+        del library["categories"][category_id]
+    return JSONResponse(content=library)
 
 class BookEditRequest(BaseModel):
     book_id: str
@@ -715,127 +2386,95 @@ class BookEditRequest(BaseModel):
 
 @app.put("/book-display-name")
 def edit_book_name(request: BookEditRequest):
-    global library_data
-    if request.book_id not in library_data["books"]:
-        raise HTTPException(status_code=404, detail="Book not found.")
-    
-    library_data["books"][request.book_id]["display_name"] = request.new_display_name
-    save_library()
-    return JSONResponse(content=library_data)
+    with library_transaction() as library:
+        if request.book_id not in library["books"]:
+            raise HTTPException(status_code=404, detail="Book not found.")
+        
+        library["books"][request.book_id]["display_name"] = request.new_display_name
+    return JSONResponse(content=library)
     
 # --- API 13: Full-Book Scan (Now without Gemini Reformatting) ---
 
 def scan_book_task(book_id: str):
-    global IS_SCANNING
-    print(f"---BACKGROUND: Starting FULL SCAN for {book_id} ---")
+    # The caller has already taken the SCAN_LOCK flock for this process.
+    log_event(f"Starting FULL SCAN for {book_id}")
     
     original_pdf_path = os.path.join(UPLOAD_DIR, book_id)
-    book_page_cache_dir = os.path.join(INGEST_PAGE_CACHE_DIR, book_id)
     summary_cache_path = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}.txt")
     
     if not os.path.exists(original_pdf_path):
-        print(f"---BACKGROUND: FAILED. Original PDF not found: {original_pdf_path} ---")
-        IS_SCANNING = False
+        log_event(f"FAILED. Original PDF not found: {original_pdf_path}", logging.ERROR)
+        release_flock(SCAN_LOCK)
         return
+    scan_succeeded = False
         
     try:
-        doc = fitz.open(original_pdf_path)
-        total_pages = len(doc)
-        print(f"---BACKGROUND: PDF opened. Found {total_pages} pages. ---")
-        full_text_pages = [] 
-
-        for page_num, page in enumerate(doc):
-            page_index = page_num + 1
-            print(f"    Scanning page {page_index}/{total_pages}...")
-            
-            # --- STEP 1: Try fast text extraction first ---
-            raw_text = page.get_text("text") or ""
-
-            is_empty = not raw_text.strip()
-            is_garbage = False
-
-            if raw_text.strip():
-                ascii_ratio = sum(ch.isascii() for ch in raw_text) / max(1, len(raw_text))
-                space_count = raw_text.count(" ")
-
-                if ascii_ratio < 0.25 or space_count < 2 or "�" in raw_text:
-                    is_garbage = True
-
-            # Decide if OCR is needed
-            needs_ocr = is_empty or is_garbage
-
-            if needs_ocr:
-                print(f"Page {page_index}: Extract failed or garbled → using OCR...")
-                try:
-                    ocr_text = ocr_document(
-                        pdf_or_image_path=original_pdf_path,
-                        page_num=page_index
-                    )
-                    text_to_use = ocr_text.strip()
-                    print("   OCR success. Waiting 3.1s...")
-                    time.sleep(3.1)
-                except Exception as e:
-                    print(f"   OCR failed: {e}")
-                    text_to_use = ""
-            else:
-                print(f"Page {page_index}: Extract success → using extracted text.")
-                text_to_use = raw_text.strip()
-            
-            # --- STEP 2: REMOVED. We no longer call Gemini to reformat. ---
-
-            # --- STEP 3: Save the (now Markdown) text to cache ---
-            page_cache_path = os.path.join(book_page_cache_dir, f"page_{page_index}.txt")
-            with open(page_cache_path, 'w', encoding='utf-8') as f:
-                f.write(text_to_use)
-            
-            full_text_pages.append(text_to_use)
-        
-        doc.close()
+        manifest = load_ingest_manifest(book_id, "scan", sha256_file(original_pdf_path))
+        # --- Gemini reformatting step was REMOVED; pages are saved as extracted / OCR'd. ---
+        full_text_pages, _ = extract_pages_with_checkpoints(
+            original_pdf_path, book_id, manifest, check_corruption=False
+        )
+        log_event(f"{len(full_text_pages)} pages scanned.")
         
         full_document_text = "\n\n".join(full_text_pages)
         with open(summary_cache_path, 'w', encoding='utf-8') as f:
             f.write(full_document_text)
-        print(f"---BACKGROUND: Full text cache overwritten with Markdown text. ---")
+        log_event("Full text cache overwritten with Markdown text.")
 
-        print(f"---BACKGROUND: Clearing stale cache files for {book_id}... ---")
+        log_event(f"Clearing stale cache files for {book_id}...")
         for filename in os.listdir(INGEST_SUMMARY_CACHE_DIR):
              if filename.startswith(book_id) and filename.endswith(".summary.txt"):
                 os.remove(os.path.join(INGEST_SUMMARY_CACHE_DIR, filename))
-                print(f"  Deleted generated summary: {filename}")
+                log_event(f"Deleted generated summary: {filename}")
         
         for filename in os.listdir(QUESTION_BANK_CACHE_DIR):
             if filename.startswith(book_id):
                 os.remove(os.path.join(QUESTION_BANK_CACHE_DIR, filename))
-                print(f"  Deleted question bank: {filename}")
+                log_event(f"Deleted question bank: {filename}")
+
+        audio_cache_dir = os.path.join(AUDIO_CACHE_DIR, book_id)
+        if os.path.exists(audio_cache_dir):
+            shutil.rmtree(audio_cache_dir)
+            log_event(f"Deleted precomputed audio for {book_id}.")
+        clear_chat_cache(book_id)
 
         # Check if ALL pages are empty → preserve PDF
         all_empty = all(not p.strip() for p in full_text_pages)
 
-        if all_empty:
-            print("!!! WARNING: All pages empty. Keeping original PDF for debugging.")
+        # Pages whose OCR failed keep the scan incomplete (and the PDF on disk) so a resume retries them.
+        manifest["complete"] = not manifest.get("failed_pages")
+        save_ingest_manifest(book_id, manifest)
+        if manifest.get("failed_pages"):
+            log_event(f"Pages {manifest['failed_pages']} have no text yet. Keeping original PDF; "
+                      f"OCR will be retried on resume.", logging.WARNING)
+        elif all_empty:
+            log_event("All pages empty. Keeping original PDF for debugging.", logging.WARNING)
         else:
             os.remove(original_pdf_path)
-            print(f"---BACKGROUND: SUCCESS! Full scan complete. Original PDF deleted. ---")
+            log_event("SUCCESS! Full scan complete. Original PDF deleted.")
+            scan_succeeded = True
 
 
     except Exception as e:
-        print(f"---BACKGROUND: !!! FATAL ERROR during full scan for {book_id}: {e} !!!")
+        log_event(f"FATAL ERROR during full scan for {book_id}: {e}", logging.ERROR)
     finally:
-        IS_SCANNING = False
+        release_flock(SCAN_LOCK)
+
+    # Runs after the scan lock is released so it does not block other scans.
+    if PRECOMPUTE_ENABLED and scan_succeeded:
+        precompute_book_task(book_id)
 
 
 @app.post("/scan-book/{book_id}")
 async def start_book_scan(book_id: str, background_tasks: BackgroundTasks):
-    global IS_SCANNING
-    if IS_SCANNING:
-        raise HTTPException(status_code=429, detail="Server is already busy scanning another book. Please try again later.")
-        
     original_pdf_path = os.path.join(UPLOAD_DIR, book_id)
     if not os.path.exists(original_pdf_path):
         raise HTTPException(status_code=404, detail="Original PDF not found. Cannot scan.")
         
-    IS_SCANNING = True
-    print(f"Adding full book scan task for {book_id} to background.")
+    # Atomic across workers: only one of several concurrent requests gets the lock.
+    if not try_acquire_flock(SCAN_LOCK):
+        raise HTTPException(status_code=429, detail="Server is already busy scanning another book. Please try again later.")
+    log_event(f"Adding full book scan task for {book_id} to background.")
     background_tasks.add_task(scan_book_task, book_id)
     
     return {"message": "Full book scan has started. This will take a long time and will reset all summaries and quizzes."}
@@ -843,56 +2482,62 @@ async def start_book_scan(book_id: str, background_tasks: BackgroundTasks):
 
 @app.delete("/book/{book_id}")
 def delete_book(book_id: str):
-    global library_data
-    if book_id not in library_data["books"]:
-        raise HTTPException(status_code=404, detail="Book not found in library.")
-    
     # 1. Delete from library.json
-    del library_data["books"][book_id]
-    save_library()
+    with library_transaction() as library:
+        if book_id not in library["books"]:
+            raise HTTPException(status_code=404, detail="Book not found in library.")
+        del library["books"][book_id]
     
     # 2. Delete from ChromaDB
     try:
-        collection.delete(where={"book_id": book_id})
-        print(f"Deleted {book_id} from ChromaDB.")
+        with file_lock(CHROMA_WRITE_LOCK):
+            get_collection().delete(where={"book_id": book_id})
+        log_event(f"Deleted {book_id} from ChromaDB.")
     except Exception as e:
-        print(f"Warning: Could not delete {book_id} from ChromaDB. {e}")
+        log_event(f"Could not delete {book_id} from ChromaDB. {e}", logging.WARNING)
 
     # 3. Delete all cache files
     try:
         page_cache_dir = os.path.join(INGEST_PAGE_CACHE_DIR, book_id)
         if os.path.exists(page_cache_dir):
             shutil.rmtree(page_cache_dir)
-            print(f"Deleted page cache for {book_id}.")
+            log_event(f"Deleted page cache for {book_id}.")
+
+        audio_cache_dir = os.path.join(AUDIO_CACHE_DIR, book_id)
+        if os.path.exists(audio_cache_dir):
+            shutil.rmtree(audio_cache_dir)
+            log_event(f"Deleted precomputed audio for {book_id}.")
             
         summary_cache_file = os.path.join(INGEST_SUMMARY_CACHE_DIR, f"{book_id}.txt")
         if os.path.exists(summary_cache_file):
             os.remove(summary_cache_file)
-            print(f"Deleted summary cache for {book_id}.")
+            log_event(f"Deleted summary cache for {book_id}.")
             
         for filename in os.listdir(INGEST_SUMMARY_CACHE_DIR):
              if filename.startswith(book_id) and filename.endswith(".summary.txt"):
                 os.remove(os.path.join(INGEST_SUMMARY_CACHE_DIR, filename))
-                print(f"  Deleted generated summary: {filename}")
+                log_event(f"Deleted generated summary: {filename}")
             
         for filename in os.listdir(QUESTION_BANK_CACHE_DIR):
             if filename.startswith(book_id):
                 os.remove(os.path.join(QUESTION_BANK_CACHE_DIR, filename))
-                print(f"  Deleted question bank: {filename}")
+                log_event(f"Deleted question bank: {filename}")
+
+        clear_chat_cache(book_id)
                 
     except Exception as e:
-        print(f"Warning: Could not delete cache files for {book_id}. {e}")
+        log_event(f"Could not delete cache files for {book_id}. {e}", logging.WARNING)
         
     # 4. Delete original PDF
     try:
         original_pdf_path = os.path.join(UPLOAD_DIR, book_id)
         if os.path.exists(original_pdf_path):
             os.remove(original_pdf_path)
-            print(f"Deleted original PDF: {original_pdf_path}")
+            log_event(f"Deleted original PDF: {original_pdf_path}")
     except Exception as e:
-        print(f"Warning: Could not delete original PDF. {e}")
+        log_event(f"Could not delete original PDF. {e}", logging.WARNING)
 
-    return JSONResponse(content=library_data)
+    return JSONResponse(content=library)
 
 
 # --- Run Server ---
@@ -0,0 +1,19 @@
+import importlib
+import os
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    """The app module, with its cwd-relative caches pointed at a temp directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("DISABLE_WARMUP", "1")
+    monkeypatch.syspath_prepend(REPO_ROOT)
+    module = importlib.import_module("main")
+    for dir_path in [module.INGEST_PAGE_CACHE_DIR, module.INGEST_SUMMARY_CACHE_DIR, module.UPLOAD_DIR,
+                     module.QUESTION_BANK_CACHE_DIR, module.AUDIO_CACHE_DIR, module.LOCK_DIR]:
+        os.makedirs(dir_path, exist_ok=True)
+    return module
@@ -0,0 +1,208 @@
+"""Fault injection: an ingest killed midway resumes without repeating OCR or embedding calls.
+
+fitz, typhoon_ocr, google.generativeai, chromadb and langchain_text_splitters
+are replaced by small in-memory stand-ins, so no PDF, network or index is needed.
+"""
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+PAGE_COUNT = 10
+OCR_PAGES = {3, 6, 9}  # pages with no text layer
+CRASH_OCR_PAGE = 6
+
+
+class Crash(BaseException):
+    """Stands in for the process being killed: not caught by `except Exception`."""
+
+
+class FakePage:
+    def __init__(self, page_num):
+        self.page_num = page_num
+
+    def get_text(self, kind):
+        if self.page_num in OCR_PAGES:
+            return ""
+        return " ".join(f"page {self.page_num} word {i}." for i in range(60))
+
+
+class FakeDoc:
+    def __init__(self):
+        self.pages = [FakePage(n) for n in range(1, PAGE_COUNT + 1)]
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def get_toc(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeSplitter:
+    def __init__(self, chunk_size, chunk_overlap, add_start_index=False):
+        self.chunk_size = chunk_size
+        self.step = chunk_size - chunk_overlap
+
+    def create_documents(self, texts):
+        text = texts[0]
+        return [types.SimpleNamespace(page_content=text[start:start + self.chunk_size],
+                                      metadata={"start_index": start})
+                for start in range(0, len(text), self.step)]
+
+
+class FakeCollection:
+    def __init__(self):
+        self.upserted_ids = []
+
+    def delete(self, where):
+        pass
+
+    def upsert(self, embeddings, documents, metadatas, ids):
+        self.upserted_ids.extend(ids)
+
+
+class Calls:
+    """Records stub calls; crash_on maps a call kind to the call number that raises Crash."""
+
+    def __init__(self):
+        self.ocr_pages = []
+        self.embed_batches = 0
+        self.crash_on = {}
+        self.ocr_fails = set()
+
+    def reset(self):
+        self.ocr_pages = []
+        self.embed_batches = 0
+        self.crash_on = {}
+        self.ocr_fails = set()
+
+
+@pytest.fixture
+def ingest_env(main, monkeypatch):
+    calls = Calls()
+    collection = FakeCollection()
+
+    def ocr_document(pdf_or_image_path, page_num):
+        if calls.crash_on.get("ocr_page") == page_num:
+            calls.crash_on.pop("ocr_page")
+            raise Crash()
+        calls.ocr_pages.append(page_num)
+        if page_num in calls.ocr_fails:
+            raise RuntimeError("OCR service unavailable")
+        return " ".join(f"ocr page {page_num} word {i}." for i in range(60))
+
+    def embed_content(model, content, task_type):
+        calls.embed_batches += 1
+        if calls.crash_on.get("embed_call") == calls.embed_batches:
+            calls.crash_on.pop("embed_call")
+            raise Crash()
+        return {"embedding": [[0.0, 1.0] for _ in content]}
+
+    fitz = types.ModuleType("fitz")
+    fitz.open = lambda path: FakeDoc()
+    typhoon_ocr = types.ModuleType("typhoon_ocr")
+    typhoon_ocr.ocr_document = ocr_document
+    genai = types.ModuleType("google.generativeai")
+    genai.configure = lambda api_key: None
+    genai.embed_content = embed_content
+    google = types.ModuleType("google")
+    google.generativeai = genai
+    chromadb = types.ModuleType("chromadb")
+    chromadb.PersistentClient = lambda path: types.SimpleNamespace(get_or_create_collection=lambda name: collection)
+    splitters = types.ModuleType("langchain_text_splitters")
+    splitters.RecursiveCharacterTextSplitter = FakeSplitter
+    for name, module in [("fitz", fitz), ("typhoon_ocr", typhoon_ocr), ("google", google),
+                         ("google.generativeai", genai), ("chromadb", chromadb),
+                         ("langchain_text_splitters", splitters)]:
+        monkeypatch.setitem(sys.modules, name, module)
+
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    # Fresh per-test state: cwd-relative SQLite connection, client cache, no OCR pause.
+    monkeypatch.setattr(main, "_sqlite_local", threading.local())
+    monkeypatch.setattr(main, "_collection", None)
+    monkeypatch.setattr(main, "EMBED_BATCH_SIZE", 3)
+    monkeypatch.setattr(main, "PRECOMPUTE_ENABLED", False)
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+
+    pdf_path = os.path.join(main.UPLOAD_DIR, "book.pdf")
+    with open(pdf_path, "wb") as f:
+        f.write(b"%PDF-1.4 fake")
+    yield main, calls, collection, pdf_path
+    main.release_flock(main.CHROMA_LOCAL_LOCK)
+
+
+def ingest(main, pdf_path):
+    main.process_and_ingest_pdf(pdf_path, "book.pdf", "uncategorized", "Book")
+
+
+def test_resumed_ingest_makes_no_duplicate_ocr_or_embedding_calls(ingest_env):
+    main, calls, collection, pdf_path = ingest_env
+
+    # Run 1: killed while OCR'ing page 6.
+    calls.crash_on = {"ocr_page": CRASH_OCR_PAGE}
+    with pytest.raises(Crash):
+        ingest(main, pdf_path)
+    assert calls.ocr_pages == [3]
+    assert calls.embed_batches == 0
+
+    # Run 2: resumes at page 6, then is killed on the second embedding batch.
+    calls.reset()
+    calls.crash_on = {"embed_call": 2}
+    with pytest.raises(Crash):
+        ingest(main, pdf_path)
+    assert calls.ocr_pages == [6, 9]
+    assert calls.embed_batches == 2
+    embedded_before_crash = list(collection.upserted_ids)
+    assert len(embedded_before_crash) == main.EMBED_BATCH_SIZE
+
+    # Run 3: no OCR at all; only the batches not yet upserted are embedded.
+    calls.reset()
+    ingest(main, pdf_path)
+    manifest = main.read_json_file(main.ingest_manifest_path("book.pdf"))
+    batches_total = len(manifest["embedding"]["done_batches"])
+    assert manifest["complete"] is True
+    assert batches_total >= 3
+    assert calls.ocr_pages == []
+    assert calls.embed_batches == batches_total - 1
+    assert len(collection.upserted_ids) == len(set(collection.upserted_ids))
+
+    # Run 4: everything is checkpointed, so a rerun calls nothing.
+    calls.reset()
+    ingest(main, pdf_path)
+    assert calls.ocr_pages == []
+    assert calls.embed_batches == 0
+
+
+def test_failed_ocr_page_keeps_ingest_incomplete_until_resume_retries_it(ingest_env):
+    main, calls, collection, pdf_path = ingest_env
+
+    # Run 1: the OCR service fails on page 9; the page is saved blank but not checkpointed.
+    calls.ocr_fails = {9}
+    ingest(main, pdf_path)
+    manifest = main.read_json_file(main.ingest_manifest_path("book.pdf"))
+    assert manifest["failed_pages"] == [9]
+    assert manifest["complete"] is False
+
+    # Startup resume retries exactly the failed page, then the job is complete.
+    calls.reset()
+    main.resume_interrupted_jobs()
+    manifest = main.read_json_file(main.ingest_manifest_path("book.pdf"))
+    assert calls.ocr_pages == [9]
+    assert manifest["failed_pages"] == []
+    assert manifest["complete"] is True
+    with open(os.path.join(main.INGEST_PAGE_CACHE_DIR, "book.pdf", "page_9.txt"), encoding="utf-8") as f:
+        assert f.read().startswith("ocr page 9")
+
+    # Nothing is left to resume.
+    calls.reset()
+    main.resume_interrupted_jobs()
+    assert calls.ocr_pages == []
+    assert calls.embed_batches == 0
@@ -0,0 +1,30 @@
+"""Context assembly: neighbouring chunks are stitched only across real splitter overlap."""
+
+
+def record(chunk_num, text):
+    return {"text": text, "metadata": {"chunk_num": chunk_num}}
+
+
+def test_consecutive_chunks_with_overlap_are_stitched(main):
+    shared = "the committee approved the budget for next year"
+    passages, stats = main.assemble_context([
+        record(4, "After a long debate, " + shared),
+        record(5, shared + " and adjourned the meeting."),
+    ])
+    assert passages == ["After a long debate, " + shared + " and adjourned the meeting."]
+    assert stats["passages"] == 1
+
+
+def test_consecutive_chunks_without_overlap_stay_separate(main):
+    # Chunks 4 and 5 sit on either side of a chapter boundary: no shared text.
+    passages, _ = main.assemble_context([
+        record(5, "Chapter Two begins in the harbour town."),
+        record(4, "The first chapter ends with a full stop."),
+    ])
+    assert passages == ["The first chapter ends with a full stop.", "Chapter Two begins in the harbour town."]
+
+
+def test_short_coincidental_overlap_is_not_stripped(main):
+    assert main.strip_overlap("the big cats", "sit on mats") == "sit on mats"
+    passages, _ = main.assemble_context([record(1, "the big cats"), record(2, "sit on mats")])
+    assert passages == ["the big cats", "sit on mats"]
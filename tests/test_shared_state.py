@@ -0,0 +1,58 @@
+"""Several worker processes sharing library.json and the scan lock must stay consistent."""
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKERS = 4
+WRITES_PER_WORKER = 30
+
+WORKER_SCRIPT = """
+import os, sys, time
+import main
+
+worker = sys.argv[1]
+while not os.path.exists("go"):
+    time.sleep(0.01)
+for i in range(int(sys.argv[2])):
+    with main.library_transaction() as library:
+        library["categories"][f"{worker}_{i}"] = f"Category {worker} {i}"
+print("lock" if main.try_acquire_flock(main.SCAN_LOCK) else "busy", flush=True)
+# Keep holding the lock until every worker has tried to take it.
+while not os.path.exists("done"):
+    time.sleep(0.01)
+"""
+
+
+def test_library_writes_and_scan_lock_across_workers(tmp_path):
+    env = dict(os.environ, DISABLE_WARMUP="1", RESUME_INTERRUPTED_JOBS="0",
+               PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    procs = [subprocess.Popen([sys.executable, "-c", WORKER_SCRIPT, f"w{n}", str(WRITES_PER_WORKER)],
+                              cwd=tmp_path, env=env, stdout=subprocess.PIPE, text=True)
+             for n in range(WORKERS)]
+    try:
+        (tmp_path / "go").touch()
+        results = []
+        deadline = time.time() + 120
+        for proc in procs:
+            for line in proc.stdout:
+                if line.strip() in ("lock", "busy"):
+                    results.append(line.strip())
+                    break
+            assert time.time() < deadline
+        (tmp_path / "done").touch()
+        for proc in procs:
+            assert proc.wait(timeout=30) == 0
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+
+    assert sorted(results) == ["busy"] * (WORKERS - 1) + ["lock"]
+
+    library = json.loads((tmp_path / "library.json").read_text(encoding="utf-8"))
+    expected = {f"w{n}_{i}" for n in range(WORKERS) for i in range(WRITES_PER_WORKER)}
+    assert expected <= set(library["categories"])
+    assert len(library["categories"]) == len(expected) + 1  # plus "uncategorized"